@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from math import radians, cos, sin, asin, sqrt
+
+EARTH_RADIUS_KM = 6371.0
+HOME_ZONE = "home"
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Calculate the great circle distance between two points
+    on the earth (specified in decimal degrees)
+    """
+    # convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    # haversine formula
+    d_lon = lon2 - lon1
+    d_lat = lat2 - lat1
+    a = sin(d_lat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(d_lon / 2) ** 2
+    c = 2 * asin(sqrt(a))
+    # Radius of earth in kilometers is 6371
+    km = EARTH_RADIUS_KM * c
+    return km
+
+
+class Zone:
+    """
+    A named circle on the map.  The trig terms for the center are worked out once here,
+    not for every vehicle on every poll.
+    """
+
+    def __init__(self, zone_id, name, latitude, longitude, radius):
+        self.zone_id = zone_id
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius = radius / 1000.0   # meters -> km
+        self.lat_rad = radians(latitude)
+        self.lon_rad = radians(longitude)
+        self.cos_lat = cos(self.lat_rad)
+
+
+class GeofenceEngine:
+    """
+    Tracks which zones each vehicle is in.  A vehicle enters a zone inside its radius, but only
+    leaves once it is past the radius plus a hysteresis margin, so GPS jitter at the edge
+    doesn't produce a stream of enter/exit events.
+    """
+
+    def __init__(self, hysteresis=0.2, min_margin=0.05):
+        self.hysteresis = hysteresis    # fraction of the radius
+        self.min_margin = min_margin    # km
+        self.zones = {}
+        self.distances = {}             # VIN -> {zone_id: km}
+        self.inside = {}                # VIN -> set of zone_ids
+        self.seen = {}                  # VIN -> set of zone_ids it has been checked against
+
+    def set_zone(self, zone_id, name, latitude, longitude, radius):
+        self.zones[zone_id] = Zone(zone_id, name, latitude, longitude, radius)
+
+    def remove_zone(self, zone_id):
+        self.zones.pop(zone_id, None)
+        for zone_ids in list(self.inside.values()) + list(self.seen.values()):
+            zone_ids.discard(zone_id)
+
+    def evaluate(self, positions):
+        """
+        Work out distances and zone membership for every vehicle against every zone in one pass.
+        positions is {VIN: (latitude, longitude)}.  Returns a list of (VIN, zone, "entered" | "exited").
+        The first check of a vehicle against a zone only sets its membership, it isn't a transition.
+        """
+        zones = list(self.zones.values())
+        transitions = []
+        for vin, (latitude, longitude) in positions.items():
+            lat_rad = radians(latitude)
+            lon_rad = radians(longitude)
+            cos_lat = cos(lat_rad)
+
+            distances = {}
+            inside = self.inside.setdefault(vin, set())
+            seen = self.seen.setdefault(vin, set())
+            for zone in zones:
+                a = sin((lat_rad - zone.lat_rad) / 2) ** 2 + zone.cos_lat * cos_lat * sin((lon_rad - zone.lon_rad) / 2) ** 2
+                km = 2 * EARTH_RADIUS_KM * asin(sqrt(a))
+                distances[zone.zone_id] = km
+                first_fix = zone.zone_id not in seen
+                seen.add(zone.zone_id)
+
+                if zone.zone_id in inside:
+                    if km > zone.radius + max(zone.radius * self.hysteresis, self.min_margin):
+                        inside.discard(zone.zone_id)
+                        if not first_fix:
+                            transitions.append((vin, zone, "exited"))
+                elif km <= zone.radius:
+                    inside.add(zone.zone_id)
+                    if not first_fix:
+                        transitions.append((vin, zone, "entered"))
+
+            self.distances[vin] = distances
+        return transitions
+
+    def distance(self, vin, zone_id):
+        return self.distances.get(vin, {}).get(zone_id)
+
+    def zone_names(self, vin):
+        return sorted(self.zones[zone_id].name for zone_id in self.inside.get(vin, ()) if zone_id in self.zones)
+
+    def vehicles_in(self, zone_id):
+        return sorted(vin for vin, zone_ids in self.inside.items() if zone_id in zone_ids)
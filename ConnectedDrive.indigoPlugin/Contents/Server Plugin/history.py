@@ -0,0 +1,151 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import threading
+import time
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    vin TEXT NOT NULL,
+    ts REAL NOT NULL,
+    mileage REAL,
+    fuel REAL,
+    battery REAL,
+    range REAL,
+    lat REAL,
+    lon REAL,
+    charging INTEGER,
+    PRIMARY KEY (vin, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily (
+    vin TEXT NOT NULL,
+    day TEXT NOT NULL,
+    mileage_start REAL,
+    mileage_end REAL,
+    fuel_used REAL,
+    battery_charged REAL,
+    samples INTEGER,
+    PRIMARY KEY (vin, day)
+) WITHOUT ROWID;
+"""
+
+# per day totals for one vehicle from start to end, worked out from the raw samples with the change since
+# the previous sample.  The last sample before start is read too, so the first day counts the change since then.
+# Parameters are (vin, vin, start, start, end, start).
+DAILY_QUERY = """
+SELECT day, MIN(mileage), MAX(mileage),
+       SUM(CASE WHEN d_fuel < 0 THEN -d_fuel ELSE 0 END),
+       SUM(CASE WHEN d_battery > 0 THEN d_battery ELSE 0 END),
+       COUNT(*)
+FROM (SELECT ts, date(ts, 'unixepoch', 'localtime') AS day, mileage,
+             fuel - LAG(fuel) OVER w AS d_fuel,
+             battery - LAG(battery) OVER w AS d_battery
+      FROM samples
+      WHERE vin = ? AND ts >= COALESCE((SELECT MAX(ts) FROM samples WHERE vin = ? AND ts < ?), ?) AND ts < ?
+      WINDOW w AS (ORDER BY ts))
+WHERE ts >= ?
+GROUP BY day ORDER BY day
+"""
+
+SAMPLE_FIELDS = ('ts', 'mileage', 'fuel', 'battery', 'range', 'lat', 'lon', 'charging')
+DAILY_FIELDS = ('day', 'mileage_start', 'mileage_end', 'fuel_used', 'battery_charged', 'samples')
+
+
+class HistoryStore:
+    """
+    Vehicle telemetry history in SQLite.  Samples are buffered and written in one transaction per
+    flush.  Raw samples are kept for retention_days, after that they are rolled up into one row per
+    vehicle per day, so the database only grows by a few hundred rows per vehicle per year.
+    Values are stored in the units the API reports (km, liters, percent).
+    """
+
+    def __init__(self, path, retention_days=30):
+        self.retention_days = retention_days
+        self.pending = []
+        self.last_ts = {}           # VIN -> timestamp of the last sample recorded
+        self.last_rollup = 0.0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(HISTORY_SCHEMA)
+            for vin, ts in self.db.execute("SELECT vin, MAX(ts) FROM samples GROUP BY vin"):
+                self.last_ts[vin] = ts
+
+    def record(self, vin, sample):
+        # the API returns the same data until the car reports in again, so skip repeats
+        if self.last_ts.get(vin) == sample['ts']:
+            return
+        self.last_ts[vin] = sample['ts']
+        charging = None if sample['charging'] is None else int(sample['charging'])
+        with self.lock:
+            self.pending.append((vin, sample['ts'], sample['mileage'], sample['fuel'], sample['battery'], sample['range'],
+                                 sample['lat'], sample['lon'], charging))
+
+    def flush(self):
+        with self.lock, self.db:
+            pending, self.pending = self.pending, []
+            if not pending:
+                return
+            self.db.executemany("INSERT OR IGNORE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", pending)
+        if time.time() - self.last_rollup > 24 * 60 * 60:
+            self.rollup()
+
+    def rollup(self):
+        """
+        Fold raw samples older than the retention period into the daily table, then delete them.
+        Only whole days are rolled up.  The last sample before the cutoff is kept, so the first
+        day after it still counts the change since that sample, the same as before the rollup.
+        """
+        self.last_rollup = time.time()
+        cutoff = time.mktime(time.localtime(time.time() - self.retention_days * 24 * 60 * 60)[:3] + (0, 0, 0, 0, 0, -1))
+        with self.lock, self.db:
+            vins = [row[0] for row in self.db.execute("SELECT DISTINCT vin FROM samples WHERE ts < ?", (cutoff,))]
+            for vin in vins:
+                start = self._rolled_until(vin)
+                rows = self.db.execute(DAILY_QUERY, (vin, vin, start, start, cutoff, start)).fetchall()
+                self.db.executemany("INSERT OR REPLACE INTO daily VALUES (?, ?, ?, ?, ?, ?, ?)", [(vin, *row) for row in rows])
+                self.db.execute("DELETE FROM samples WHERE vin = ? AND ts < (SELECT MAX(ts) FROM samples WHERE vin = ? AND ts < ?)",
+                                (vin, vin, cutoff))
+
+    def _rolled_until(self, vin):
+        # midnight after the last day already in the daily table, raw samples before it have been rolled up
+        day = self.db.execute("SELECT MAX(day) FROM daily WHERE vin = ?", (vin,)).fetchone()[0]
+        if not day:
+            return 0.0
+        year, month, mday = map(int, day.split("-"))
+        return time.mktime((year, month, mday + 1, 0, 0, 0, 0, 0, -1))
+
+    def samples(self, vin, hours):
+        since = time.time() - hours * 60 * 60
+        self.flush()
+        with self.lock:
+            rows = self.db.execute(f"SELECT {', '.join(SAMPLE_FIELDS)} FROM samples WHERE vin = ? AND ts >= ? ORDER BY ts", (vin, since)).fetchall()
+        return [dict(zip(SAMPLE_FIELDS, row)) for row in rows]
+
+    def daily(self, vin, days):
+        """
+        Per day mileage, fuel used and battery percent charged for the last N days,
+        from the rolled up table for old days and the raw samples for recent ones.
+        """
+        since_ts = time.mktime(time.localtime(time.time() - days * 24 * 60 * 60)[:3] + (0, 0, 0, 0, 0, -1))
+        since = time.strftime("%Y-%m-%d", time.localtime(since_ts))
+        self.flush()
+        with self.lock:
+            rows = self.db.execute(f"SELECT {', '.join(DAILY_FIELDS)} FROM daily WHERE vin = ? AND day >= ? ORDER BY day", (vin, since)).fetchall()
+            start = max(since_ts, self._rolled_until(vin))
+            rows += self.db.execute(DAILY_QUERY, (vin, vin, start, start, time.time() + 1, start)).fetchall()
+
+        result = []
+        for row in rows:
+            entry = dict(zip(DAILY_FIELDS, row))
+            distance = (entry['mileage_end'] or 0) - (entry['mileage_start'] or 0)
+            entry['distance'] = distance
+            entry['fuel_per_100km'] = round(entry['fuel_used'] / distance * 100.0, 2) if distance > 0 and entry['fuel_used'] else None
+            result.append(entry)
+        return result
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
@@ -4,39 +4,134 @@
 import indigo
 import json
 import logging
+import os
 import contextlib
+import cProfile
+import io
+import pstats
 import time
 import datetime
 import asyncio
-from aiohttp import ClientSession
+import heapq
+import bisect
+import random
+import httpx
+import ssl
+import certifi
 import threading
 
-from math import radians, cos, sin, asin, sqrt
-from pint import UnitRegistry
-
 from bimmer_connected.account import MyBMWAccount
 from bimmer_connected.api.regions import get_region_from_name, valid_regions
 from bimmer_connected.vehicle.vehicle import VehicleViewDirection
+from bimmer_connected.vehicle.doors_windows import LockState
 from bimmer_connected.utils import MyBMWJSONEncoder
+from bimmer_connected.models import MyBMWAuthError, MyBMWCaptchaMissingError, MyBMWQuotaError
+
+from units import get_units, verify_with_pint
+from geofence import GeofenceEngine, HOME_ZONE
+from history import HistoryStore
+from sessions import SessionDetector
+from metrics import Metrics, SIZE_BUCKETS
+from subscriptions import SubscriptionRegistry, select_fields
 
 AUTH_TOKEN_PLUGIN_PREF = 'auth_tokens-{}'
+SUBSCRIPTIONS_PLUGIN_PREF = 'subscriptions'
+VEHICLE_UPDATE_BROADCAST = "vehicleUpdate"
 CAPTCHA_URL = "https://bimmer-connected.readthedocs.io/en/stable/captcha.html"
+VEHICLE_CACHE_FILE = "vehicle_cache.json"
+VEHICLE_CACHE_VERSION = 1
+VEHICLE_CACHE_SAVE_DELAY = 30.0  # seconds, account polls finishing within this window share one cache write
+HISTORY_FILE = "history.sqlite"
+FIXTURES_FOLDER = "fixtures"
+HOME_LOCATION_TTL = 60.0 * 60.0  # seconds before the server's home location is read again
+HEARTBEAT_INTERVAL = 60.0 * 60.0  # seconds between last_update writes when nothing else changed
+
+ACTIVE_POLL_INTERVAL = 2.0 * 60.0       # vehicle is being driven
+CHARGING_POLL_INTERVAL = 5.0 * 60.0     # charger connected and battery level rising
+PARKED_POLL_CEILING = 4.0 * 60.0 * 60.0 # upper limit of the backoff while parked and locked
+
+POLL_RETRY_BASE = 30.0             # first retry after a failed account poll, doubled for each failure
+POLL_RETRY_MAX = 30.0 * 60.0
+BREAKER_THRESHOLD = 3              # consecutive failures before an account's circuit opens
+POLL_JITTER = 0.1                  # fraction of each poll interval randomized, so accounts drift apart
+ACCOUNT_STAGGER = 15.0             # seconds between accounts that would otherwise poll at the same time
+STALE_AFTER_POLLS = 2.0            # data older than this many poll intervals is stale
+# data_age is the last of these (minutes) the data has reached, so the state changes a few times a day, not every minute
+DATA_AGE_BUCKETS = [0, 15, 30, 60, 2 * 60, 4 * 60, 8 * 60, 12 * 60, 24 * 60, 2 * 24 * 60, 7 * 24 * 60]
+
+TOKEN_REFRESH_MARGIN = 5.0 * 60.0  # refresh access tokens this long before they expire
+TOKEN_CHECK_INTERVAL = 5.0 * 60.0  # longest the token refresher sleeps between checks
+TOKEN_RETRY_BASE = 60.0            # first retry delay after a failed refresh, doubled for each failure
+TOKEN_RETRY_MAX = 60.0 * 60.0
+PREFS_SAVE_DELAY = 2.0             # token changes within this window share one savePluginPrefs
+
+# errors that mean the account has to be logged in again.  A rejected refresh token makes bimmer_connected
+# fall back to a password login, which fails with MyBMWCaptchaMissingError, not MyBMWAuthError.
+AUTH_ERRORS = (MyBMWAuthError, MyBMWCaptchaMissingError)
+
+LOOP_LAG_INTERVAL = 10.0           # seconds between event loop lag samples
+PROFILE_FILE = "poll_profile.prof"
+
+SCHEDULER_MAX_SLEEP = 60.0    # longest the scheduler sleeps between checks when nothing is due
+COMMAND_REFRESH_DELAY = 5.0   # seconds after a vehicle's command queue drains before refreshing it
+COMMAND_COALESCE_DELAY = 1.5  # seconds a command waits in an idle queue, so a quick follow-up can replace it
+
+FLEET_COMMAND_SPACING = 2.0   # minimum seconds between fleet commands starting on one account
+FLEET_RETRIES = 2             # extra attempts for a vehicle after a transient failure
+FLEET_RETRY_DELAY = 30.0      # seconds before the first retry, doubled for each one after
+FLEET_COMMAND_TIMEOUT = 15.0 * 60.0
+
+# queued commands in the same group supersede each other, so lock then unlock within
+# COMMAND_COALESCE_DELAY (or while another command is in flight) only sends unlock
+COMMAND_GROUPS = {
+    'lock': 'doors',
+    'unlock': 'doors',
+    'climate': 'climate',
+    'climate_off': 'climate',
+    'charge_start': 'charging',
+    'charge_stop': 'charging',
+}
 
-def haversine(lon1, lat1, lon2, lat2):
+########################################################################################
+
+class VehicleSnapshot:
     """
-    Calculate the great circle distance between two points
-    on the earth (specified in decimal degrees)
+    One vehicle's data at one point in time. The vehicle is JSON encoded once when the snapshot
+    is taken; the dict form is only decoded if something actually reads it.
     """
-    # convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-    # haversine formula
-    d_lon = lon2 - lon1
-    d_lat = lat2 - lat1
-    a = sin(d_lat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(d_lon / 2) ** 2
-    c = 2 * asin(sqrt(a))
-    # Radius of earth in kilometers is 6371
-    km = 6371 * c
-    return km
+
+    def __init__(self, account, encoded, fetched=None, cached=False, vehicle=None, reported=None):
+        self.account = account
+        self.encoded = encoded
+        self.fetched = fetched or time.time()
+        self.reported = reported or self.fetched     # when the car itself last reported this data
+        self.cached = cached
+        self._vehicle = vehicle
+
+    @classmethod
+    def from_vehicle(cls, account, vehicle):
+        reported = vehicle.timestamp.timestamp() if vehicle.timestamp else None
+        return cls(account, json.dumps(vehicle, cls=MyBMWJSONEncoder), reported=reported)
+
+    @property
+    def vehicle(self):
+        if self._vehicle is None:
+            self._vehicle = json.loads(self.encoded)
+        return self._vehicle
+
+    @property
+    def age(self):
+        return max(0.0, time.time() - self.reported)
+
+    def as_dict(self):
+        return {'account': self.account, 'fetched': self.fetched, 'reported': self.reported, 'cached': self.cached,
+                'vehicle': self.vehicle}
+
+    def to_json(self, **extra):
+        # splice in the cached vehicle encoding instead of serializing the vehicle again
+        header = json.dumps({'account': self.account, 'fetched': self.fetched, 'reported': self.reported,
+                             'cached': self.cached, **extra})
+        return f'{header[:-1]}, "vehicle": {self.encoded}}}'
 
 ########################################################################################
 
@@ -56,10 +151,34 @@ class Plugin(indigo.PluginBase):
         self.updateFrequency = float(pluginPrefs.get('updateFrequency', "30")) * 60.0
         self.logger.debug(f"updateFrequency = {self.updateFrequency}")
         self.next_update = time.time() + 30.0  # give time for devices to get initialized
-        self.need_update = False
 
-        self.units = pluginPrefs.get('units', "us")
-        self.ureg = UnitRegistry()
+        self.max_concurrent_accounts = int(pluginPrefs.get('maxConcurrentAccounts', "4"))
+        self.account_timeout = float(pluginPrefs.get('accountTimeout', "120"))
+        self.logger.debug(f"max_concurrent_accounts = {self.max_concurrent_accounts}, account_timeout = {self.account_timeout}")
+        self.account_next_update = {}   # account device id -> due time, only written on the event loop
+        self.account_tasks = {}
+        self.account_semaphore = None
+        self.account_health = {}        # account device id -> {'failures', 'retry_at', 'open'}
+        self.schedule = []              # heap of (due time, account device id), may hold stale entries
+        self.wake_event = asyncio.Event()
+        self.stopping = False
+
+        self.metrics = Metrics()
+        self.profile_next_update = False
+
+        self.token_state = {}           # account device id -> {'tokens', 'failures', 'retry_at', 'incident'}
+        self.prefs_save_handle = None
+        self.cache_save_handle = None
+        self.data_age_handle = None     # timer for the next stale or data_age change, and when it is due
+        self.data_age_due = None
+
+        self.units = get_units(pluginPrefs.get('units', "us"))
+
+        self.geofence = GeofenceEngine()
+        self.sessions = SessionDetector()
+        self.cd_zones = {}              # zone id -> device id, only touched on the event loop
+        self.home_radius = float(pluginPrefs.get('homeRadius', "200"))
+        self.home_location_time = 0.0
 
         self.bridge_data = {}
         self.wrappers = {}
@@ -68,39 +187,328 @@ class Plugin(indigo.PluginBase):
         self.cd_accounts = {}
         self.cd_vehicles = {}
         self.vehicle_data = {}
+        self.data_folder = None
+        self.vehicle_cache_path = None
+        self.history = None
+        self.history_retention = int(pluginPrefs.get('historyRetentionDays', "30"))
         self.triggers = []
 
+        self.state_cache = {}       # device id -> {state key: (value, uiValue)} last pushed to the server
+        self.heartbeat_times = {}   # device id -> time the heartbeat state was last pushed
+        self.states_written = 0
+        self.states_skipped = 0
+
+        self.vehicle_poll = {}      # VIN -> {'interval', 'reason', 'battery'} from the last poll
+
+        self.command_queues = {}    # VIN -> list of pending commands, only touched on the event loop
+        self.command_workers = {}   # VIN -> task draining that vehicle's queue
+        self.vehicle_tasks = {}     # VIN -> in-flight single vehicle refresh
+
+        self.fleet_concurrency = int(pluginPrefs.get('fleetConcurrency', "2"))
+        self.fleet_limiters = {}    # account device id -> semaphore limiting fleet commands in flight
+        self.fleet_last_start = {}  # account device id -> when its last fleet command was queued
+        self.fleet_tasks = set()    # fleet commands in progress
+        self.last_fleet_result = None
+
+        self.subscriptions = SubscriptionRegistry()
+        with contextlib.suppress(json.JSONDecodeError, KeyError):
+            self.subscriptions.load(json.loads(pluginPrefs.get(SUBSCRIPTIONS_PLUGIN_PREF, "[]")))
+
         self.event_loop = None
         self.async_thread = None
 
+        # bimmer_connected opens an httpx client per request, so share one SSL context
+        # across all accounts instead of loading the CA bundle for every client
+        self.ssl_context = ssl.create_default_context(cafile=certifi.where())
+
     def startup(self):
+        self.data_folder = data_folder = f"{indigo.server.getInstallFolderPath()}/Preferences/Plugins/{self.pluginId}"
+        os.makedirs(data_folder, exist_ok=True)
+        self.vehicle_cache_path = os.path.join(data_folder, VEHICLE_CACHE_FILE)
+        self.load_vehicle_cache()
+        self.history = HistoryStore(os.path.join(data_folder, HISTORY_FILE), retention_days=self.history_retention)
+
+        # create the loop here so device_start_comm can schedule work on it right away
+        self.event_loop = asyncio.new_event_loop()
         threading.Thread(target=self.run_async_thread).start()
 
+    def shutdown(self):
+        self.call_on_loop(self.stop_scheduler)
+
+    def stop_concurrent_thread(self):
+        # wake the scheduler so it sees stopThread now, not at its next timeout
+        self.stopThread = True
+        self.call_on_loop(self.stop_scheduler)
+
+    def call_on_loop(self, callback, *args):
+        """
+        Run callback on the event loop, from any thread.  Does nothing once the loop has
+        shut down, which Indigo callbacks can still arrive after.  Returns True if it was queued.
+        """
+        if not self.event_loop or self.event_loop.is_closed():
+            return False
+        try:
+            self.event_loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:    # closed since the check
+            return False
+        return True
+
+    def load_vehicle_cache(self):
+        try:
+            with open(self.vehicle_cache_path, "r") as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"load_vehicle_cache: unable to read {self.vehicle_cache_path}: {e}")
+            return
+
+        if cache.get('version') != VEHICLE_CACHE_VERSION:
+            self.logger.debug(f"load_vehicle_cache: ignoring cache version {cache.get('version')}")
+            return
+
+        for vin, entry in cache['vehicles'].items():
+            self.vehicle_data[vin] = VehicleSnapshot(entry['account'], json.dumps(entry['vehicle']), fetched=entry['fetched'],
+                                                     cached=True, vehicle=entry['vehicle'], reported=entry.get('reported'))
+        self.logger.debug(f"load_vehicle_cache: loaded {len(self.vehicle_data)} vehicles")
+
+    def request_cache_save(self):
+        # event loop only
+        if not self.cache_save_handle:
+            self.cache_save_handle = self.event_loop.call_later(VEHICLE_CACHE_SAVE_DELAY, self.save_vehicle_cache)
+
+    def forget_account_vehicles(self, dev_id=None):
+        """
+        Event loop only.  Drop the vehicles of a deleted account, or with no dev_id, of every account
+        that is no longer an Indigo device, so they leave the cache and the vehicle list.
+        """
+        for vin, snapshot in list(self.vehicle_data.items()):
+            if snapshot.account == dev_id or (dev_id is None and int(snapshot.account) not in indigo.devices):
+                self.logger.debug(f"forget_account_vehicles: {vin} belonged to deleted account {snapshot.account}")
+                del self.vehicle_data[vin]
+                self.vehicle_poll.pop(vin, None)
+
+    def save_vehicle_cache(self):
+        self.cache_save_handle = None
+        self.forget_account_vehicles()
+        # write to a temp file and rename, so a crash never leaves a partial cache behind
+        vehicles = ",".join(f"{json.dumps(vin)}:{snapshot.to_json()}" for vin, snapshot in self.vehicle_data.items())
+        temp_path = f"{self.vehicle_cache_path}.tmp"
+        try:
+            with open(temp_path, "w") as f:
+                f.write(f'{{"version":{VEHICLE_CACHE_VERSION},"saved":{time.time()},"vehicles":{{{vehicles}}}}}')
+            os.replace(temp_path, self.vehicle_cache_path)
+        except OSError as e:
+            self.logger.warning(f"save_vehicle_cache: unable to write {self.vehicle_cache_path}: {e}")
+
     def run_async_thread(self):
         self.logger.debug("run_async_thread starting")
-        self.event_loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.event_loop)
         self.event_loop.run_until_complete(self.async_main())
         self.event_loop.close()
+        self.history.close()
         self.logger.debug("run_async_thread exiting")
 
     async def async_main(self):
         self.logger.debug("async_main starting")
+        self.account_semaphore = asyncio.Semaphore(self.max_concurrent_accounts)
+        token_task = self.event_loop.create_task(self.token_refresher())
+        lag_task = self.event_loop.create_task(self.loop_lag_monitor())
+
+        while not (self.stopping or self.stopThread):
+            self.start_due_accounts()
+
+            # sleep until the next account is due, or until something wakes us
+            delay = SCHEDULER_MAX_SLEEP
+            if self.schedule:
+                delay = min(delay, max(0.0, self.schedule[0][0] - time.time()))
+            self.wake_event.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wake_event.wait(), timeout=delay)
+
+        self.logger.debug("async_main: stopping")
+        tasks = [token_task, lag_task] + list(self.account_tasks.values()) + list(self.vehicle_tasks.values()) + \
+                list(self.command_workers.values()) + list(self.fleet_tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.prefs_save_handle:
+            self.prefs_save_handle.cancel()
+            self.save_prefs()
+        if self.cache_save_handle:
+            self.cache_save_handle.cancel()
+            self.save_vehicle_cache()
+        if self.data_age_handle:
+            self.data_age_handle.cancel()
+        self.logger.debug("async_main: exiting")
 
-        while True:
-            await asyncio.sleep(0.1)
-            if self.stopThread:
-                self.logger.debug("async_main: stopping")
-                break
+    def start_due_accounts(self):
+        # each account keeps its own due time, so a slow account never delays the others
+        now = time.time()
+        while self.schedule and self.schedule[0][0] <= now:
+            due, dev_id = heapq.heappop(self.schedule)
+            if dev_id not in self.cd_accounts or self.account_next_update.get(dev_id) != due:
+                continue    # account removed or rescheduled since this entry was pushed
+            if dev_id in self.account_tasks:
+                continue    # run_account_update puts it back on the schedule when it finishes
+            health = self.account_health.get(dev_id)
+            if health and health['open'] and now < health['retry_at']:
+                self.schedule_account(dev_id, health['retry_at'])
+                continue    # circuit open, only the scheduled probe goes out
+            self.schedule_account(dev_id, now + self.jittered(self.updateFrequency))
+            self.account_tasks[dev_id] = self.event_loop.create_task(self.run_account_update(dev_id))
+
+    def schedule_account(self, dev_id, due):
+        # event loop only
+        self.account_next_update[dev_id] = due
+        heapq.heappush(self.schedule, (due, dev_id))
+        self.wake_event.set()
+
+    def schedule_all_accounts(self, due=None):
+        # event loop only
+        due = due or time.time()
+        for index, dev_id in enumerate(list(self.cd_accounts.keys())):
+            self.schedule_account(dev_id, due + index * ACCOUNT_STAGGER)
+
+    def unschedule_account(self, dev_id):
+        # event loop only, the heap entry is dropped when it comes due
+        self.account_next_update.pop(dev_id, None)
+
+    def request_update(self, dev_id=None, due=None):
+        # safe to call from Indigo callback threads
+        if dev_id is None:
+            self.call_on_loop(self.schedule_all_accounts, due)
+        else:
+            self.call_on_loop(self.schedule_account, dev_id, due or time.time())
 
-            if time.time() > self.next_update or self.need_update:
-                self.next_update = time.time() + self.updateFrequency
-                self.need_update = False
+    @staticmethod
+    def jittered(interval):
+        return interval * random.uniform(1.0 - POLL_JITTER, 1.0 + POLL_JITTER)
 
-                for dev_id in self.cd_accounts.keys():
-                    await self.do_account_update(dev_id)
+    def stop_scheduler(self):
+        self.stopping = True
+        self.wake_event.set()
 
-        self.logger.debug("async_main: exiting")
+    async def run_account_update(self, dev_id):
+        profiler = None
+        succeeded = False
+        try:
+            async with self.account_semaphore:
+                if self.profile_next_update:
+                    self.profile_next_update = False
+                    profiler = cProfile.Profile()
+                    profiler.enable()
+                with self.metrics.timer("update.account"):
+                    succeeded = await asyncio.wait_for(self.do_account_update(dev_id), timeout=self.account_timeout)
+        except asyncio.TimeoutError:
+            self.metrics.count("error.TimeoutError")
+            self.logger.warning(f"run_account_update: account {dev_id} timed out after {self.account_timeout} seconds")
+        except asyncio.CancelledError:
+            succeeded = None
+            raise
+        except Exception as e:
+            self.metrics.count(f"error.{type(e).__name__}")
+            self.logger.warning(f"run_account_update: account {dev_id} error: {e}")
+        finally:
+            if profiler:
+                profiler.disable()
+                self.report_profile(profiler)
+            self.account_tasks.pop(dev_id, None)
+            if dev_id in self.account_next_update:
+                if succeeded:
+                    self.account_succeeded(dev_id)
+                elif succeeded is False:
+                    self.account_failed(dev_id)
+                self.schedule_account(dev_id, self.account_next_update[dev_id])
+
+    def account_failed(self, dev_id):
+        """
+        Retry a failed account poll with a jittered exponential backoff.  After BREAKER_THRESHOLD failures
+        in a row the account's circuit opens: nothing else is sent for it until the next retry, which
+        probes whether the API is back.
+        """
+        health = self.account_health.setdefault(dev_id, {'failures': 0, 'retry_at': 0.0, 'open': False})
+        health['failures'] += 1
+        delay = min(POLL_RETRY_BASE * 2 ** (health['failures'] - 1), POLL_RETRY_MAX)
+        # full jitter, so accounts that failed together don't retry together
+        health['retry_at'] = time.time() + random.uniform(delay / 2.0, delay)
+        self.metrics.count("poll.retry")
+
+        account_dev = indigo.devices[int(dev_id)]
+        if health['failures'] >= BREAKER_THRESHOLD and not health['open']:
+            health['open'] = True
+            self.metrics.count("poll.circuit_open")
+            self.logger.warning(f"{account_dev.name}: {health['failures']} polls failed in a row, backing off until the API responds again")
+        self.logger.debug(f"{account_dev.name}: poll failed ({health['failures']}), retrying in {health['retry_at'] - time.time():.0f} seconds")
+
+        self.account_next_update[dev_id] = health['retry_at']
+        self.update_changed_states(account_dev, [{'key': 'poll_state', 'value': "offline" if health['open'] else "retrying"},
+                                                 {'key': 'poll_failures', 'value': health['failures']}])
+        self.mark_stale_vehicles(dev_id)
+
+    def account_succeeded(self, dev_id):
+        health = self.account_health.get(dev_id)
+        account_dev = indigo.devices[int(dev_id)]
+        if health and health['open']:
+            self.logger.info(f"{account_dev.name}: API responding again after {health['failures']} failed polls")
+        self.account_health[dev_id] = {'failures': 0, 'retry_at': 0.0, 'open': False}
+        self.update_changed_states(account_dev, [{'key': 'poll_state', 'value': "ok"},
+                                                 {'key': 'poll_failures', 'value': 0}])
+
+    def vehicle_data_age(self, vin):
+        """
+        Returns (age in seconds, stale) for a vehicle's data, aged from when the car reported it rather than
+        when it was fetched.  Data is stale once it is older than STALE_AFTER_POLLS of its poll intervals,
+        or while its account's circuit is open.
+        """
+        snapshot = self.vehicle_data[vin]
+        interval = self.vehicle_poll.get(vin, {}).get('interval', self.updateFrequency)
+        health = self.account_health.get(snapshot.account)
+        return snapshot.age, snapshot.age > STALE_AFTER_POLLS * interval or bool(health and health['open'])
+
+    def data_age_states(self, vin):
+        age, stale = self.vehicle_data_age(vin)
+        minutes = DATA_AGE_BUCKETS[bisect.bisect_right(DATA_AGE_BUCKETS, age / 60.0) - 1]
+        return [{'key': 'stale', 'value': stale},
+                {'key': 'data_age', 'value': minutes, 'uiValue': f"{minutes}+ min"}]
+
+    def next_data_age_change(self, vin):
+        # when this vehicle's stale or data_age state changes if no new data arrives, None if it never does
+        snapshot = self.vehicle_data[vin]
+        interval = self.vehicle_poll.get(vin, {}).get('interval', self.updateFrequency)
+        changes = [snapshot.reported + STALE_AFTER_POLLS * interval]
+        if (index := bisect.bisect_right(DATA_AGE_BUCKETS, snapshot.age / 60.0)) < len(DATA_AGE_BUCKETS):
+            changes.append(snapshot.reported + DATA_AGE_BUCKETS[index] * 60.0)
+        return min((change for change in changes if change > time.time()), default=None)
+
+    def schedule_data_age_check(self, due):
+        # event loop only.  One timer for the whole fleet, set for whichever vehicle's states change first.
+        if due is None or (self.data_age_due is not None and self.data_age_due <= due):
+            return
+        if self.data_age_handle:
+            self.data_age_handle.cancel()
+        self.data_age_due = due
+        self.data_age_handle = self.event_loop.call_later(max(0.0, due - time.time()) + 1.0, self.check_data_ages)
+
+    def check_data_ages(self):
+        self.data_age_handle = self.data_age_due = None
+        self.mark_stale_vehicles()
+
+    def refresh_data_age(self, vin):
+        # event loop only.  The vehicle keeps its last states, but shows how old they are.
+        if vin not in self.vehicle_data:
+            return
+        if (device_id := self.cd_vehicles.get(vin)) and (device := indigo.devices.get(int(device_id))):
+            self.update_changed_states(device, self.data_age_states(vin))
+        self.schedule_data_age_check(self.next_data_age_change(vin))
+
+    def mark_stale_vehicles(self, dev_id=None):
+        # with no dev_id, every account's vehicles
+        for vin, snapshot in list(self.vehicle_data.items()):
+            if dev_id is None or snapshot.account == dev_id:
+                self.refresh_data_age(vin)
 
 ########################################################################################
 
@@ -110,6 +518,34 @@ class Plugin(indigo.PluginBase):
         updateFrequency = int(valuesDict.get('updateFrequency', 15))
         if (updateFrequency < 5) or (updateFrequency > 60):
             errorDict['updateFrequency'] = "Update frequency is invalid - enter a valid number (between 5 and 60)"
+        try:
+            maxConcurrentAccounts = int(valuesDict.get('maxConcurrentAccounts', 4))
+            if (maxConcurrentAccounts < 1) or (maxConcurrentAccounts > 32):
+                raise ValueError
+        except ValueError:
+            errorDict['maxConcurrentAccounts'] = "Concurrent accounts is invalid - enter a valid number (between 1 and 32)"
+        try:
+            accountTimeout = int(valuesDict.get('accountTimeout', 120))
+            if (accountTimeout < 10) or (accountTimeout > 600):
+                raise ValueError
+        except ValueError:
+            errorDict['accountTimeout'] = "Account timeout is invalid - enter a valid number (between 10 and 600)"
+        try:
+            if float(valuesDict.get('homeRadius', 200)) <= 0:
+                raise ValueError
+        except ValueError:
+            errorDict['homeRadius'] = "Home radius is invalid - enter a number of meters greater than 0"
+        try:
+            if int(valuesDict.get('historyRetentionDays', 30)) < 1:
+                raise ValueError
+        except ValueError:
+            errorDict['historyRetentionDays'] = "History retention is invalid - enter a number of days greater than 0"
+        try:
+            fleetConcurrency = int(valuesDict.get('fleetConcurrency', 2))
+            if (fleetConcurrency < 1) or (fleetConcurrency > 10):
+                raise ValueError
+        except ValueError:
+            errorDict['fleetConcurrency'] = "Fleet commands per account is invalid - enter a valid number (between 1 and 10)"
         if len(errorDict) > 0:
             return False, valuesDict, errorDict
         return True
@@ -119,9 +555,26 @@ class Plugin(indigo.PluginBase):
             self.logLevel = int(valuesDict.get("logLevel", logging.INFO))
             self.indigo_log_handler.setLevel(self.logLevel)
             self.updateFrequency = float(valuesDict['updateFrequency']) * 60.0
-            self.next_update = time.time()
+            self.units = get_units(valuesDict.get('units', "us"))
+            self.home_radius = float(valuesDict.get('homeRadius', "200"))
+            self.home_location_time = 0.0
+            self.history_retention = int(valuesDict.get('historyRetentionDays', "30"))
+            if self.history:
+                self.history.retention_days = self.history_retention
+            self.account_timeout = float(valuesDict.get('accountTimeout', "120"))
+            self.fleet_concurrency = int(valuesDict.get('fleetConcurrency', "2"))
+            self.call_on_loop(self.fleet_limiters.clear)
+            max_concurrent_accounts = int(valuesDict.get('maxConcurrentAccounts', "4"))
+            if max_concurrent_accounts != self.max_concurrent_accounts:
+                self.max_concurrent_accounts = max_concurrent_accounts
+                self.call_on_loop(self.reset_account_semaphore)
+            self.request_update()
             self.logger.debug(f"closed_prefs_config_ui, logLevel = {self.logLevel}, updateFrequency = {self.updateFrequency}")
 
+    def reset_account_semaphore(self):
+        # in-flight updates keep the old semaphore, new ones pick up the new limit
+        self.account_semaphore = asyncio.Semaphore(self.max_concurrent_accounts)
+
     ########################################################################################
 
     def get_device_config_ui_values(self, pluginProps, typeId, devId):
@@ -153,6 +606,23 @@ class Plugin(indigo.PluginBase):
         elif typeId == "cdVehicle":
             pass
 
+        elif typeId == "cdZone":
+            try:
+                if not -90.0 <= float(valuesDict.get("latitude", "")) <= 90.0:
+                    raise ValueError
+            except ValueError:
+                errorsDict["latitude"] = "Latitude must be a number between -90 and 90"
+            try:
+                if not -180.0 <= float(valuesDict.get("longitude", "")) <= 180.0:
+                    raise ValueError
+            except ValueError:
+                errorsDict["longitude"] = "Longitude must be a number between -180 and 180"
+            try:
+                if float(valuesDict.get("radius", "")) <= 0:
+                    raise ValueError
+            except ValueError:
+                errorsDict["radius"] = "Radius must be a number of meters greater than 0"
+
         if len(errorsDict):
             return False, valuesDict, errorsDict
 
@@ -164,13 +634,12 @@ class Plugin(indigo.PluginBase):
             return
 
         self.logger.debug(f"closed_device_config_ui, {typeId=}, {devId=}, {dict(valuesDict)=}")
+        if typeId != "cdAccount":
+            return valuesDict
 
         # Attempt to create a MyBMWAccount object to validate the credentials
         try:
-            account = MyBMWAccount(valuesDict.get("username"),
-                                   valuesDict.get("password"),
-                                   get_region_from_name(valuesDict.get("region")),
-                                   hcaptcha_token=valuesDict.get("captcha_token"))
+            account = self.create_account(valuesDict, hcaptcha_token=valuesDict.get("captcha_token"))
         except Exception as e:
             self.logger.debug(f"get_tokens create account error: {e}")
 
@@ -182,7 +651,9 @@ class Plugin(indigo.PluginBase):
 
         self.cd_accounts[devId] = account
         try:
-            auth_data = asyncio.run(self.get_account_data(account))
+            # validate on the plugin's event loop, not a throwaway one
+            future = asyncio.run_coroutine_threadsafe(self.get_account_data(account), self.event_loop)
+            auth_data = future.result(timeout=self.account_timeout)
         except Exception as e:
             self.logger.debug(f"get_tokens get data error: {e}")
 
@@ -191,11 +662,12 @@ class Plugin(indigo.PluginBase):
                     indigo.trigger.execute(trigger)
             return
 
+        # saved right away, device_start_comm reads these when the device restarts
         if auth_data:
             self.pluginPrefs[AUTH_TOKEN_PLUGIN_PREF.format(devId)] = json.dumps(auth_data)
             self.savePluginPrefs()
 
-        self.need_update = True
+        self.request_update()
 
         return valuesDict
 
@@ -219,52 +691,262 @@ class Plugin(indigo.PluginBase):
 
     ################################################################################
 
+    def create_account(self, props, hcaptcha_token=None):
+        return MyBMWAccount(props.get("username"),
+                            props.get("password"),
+                            get_region_from_name(props.get("region")),
+                            hcaptcha_token=hcaptcha_token,
+                            verify=self.ssl_context)
+
     def device_start_comm(self, device):
         self.logger.info(f"{device.name}: Starting {device.deviceTypeId} Device")
 
         if device.deviceTypeId == "cdAccount":
 
-            account = MyBMWAccount(device.pluginProps['username'], device.pluginProps['password'], get_region_from_name(device.pluginProps['region']))
+            account = self.create_account(device.pluginProps)
             self.cd_accounts[device.id] = account
+            self.token_state[device.id] = {'tokens': None, 'failures': 0, 'retry_at': 0.0, 'incident': False}
             if auth_json := self.pluginPrefs.get(AUTH_TOKEN_PLUGIN_PREF.format(device.id)):
                 with contextlib.suppress(json.JSONDecodeError):
                     account.set_refresh_token(**json.loads(auth_json))
+                    self.token_state[device.id]['tokens'] = json.loads(auth_json)
             else:
                 self.logger.warning(f"{device.name}: No auth data found")
 
+            # with cached data on hand, wait out the normal interval instead of polling right after a restart,
+            # and spread the accounts out so they don't all start at the same moment
+            due = self.next_update + (len(self.cd_accounts) - 1) * ACCOUNT_STAGGER
+            self.account_health[device.id] = {'failures': 0, 'retry_at': 0.0, 'open': False}
+            fetched = [v.fetched for v in self.vehicle_data.values() if v.account == device.id]
+            if fetched:
+                due = max(due, min(fetched) + self.updateFrequency)
+            self.request_update(device.id, due)
+
         elif device.deviceTypeId == "cdVehicle":
-            self.need_update = True
+            if device.address not in self.vehicle_data:
+                self.request_update()
             self.cd_vehicles[device.address] = device.id
+            self.call_on_loop(self.refresh_data_age, device.address)
+
+        elif device.deviceTypeId == "cdZone":
+            # polls evaluate the zones on the event loop, so they only change there
+            self.call_on_loop(self.add_zone, device.id, device.name, float(device.pluginProps['latitude']),
+                              float(device.pluginProps['longitude']), float(device.pluginProps['radius']))
 
         else:
             self.logger.error(f"{device.name}: deviceStartComm: Unknown device type: {device.deviceTypeId}")
 
         device.stateListOrDisplayStateIdChanged()
 
+        self.state_cache.pop(device.id, None)
+        self.heartbeat_times.pop(device.id, None)
+
     def device_stop_comm(self, device):
         self.logger.info(f"{device.name}: Stopping {device.deviceTypeId} Device {device.id}")
 
         if device.deviceTypeId == "cdAccount":
             del self.cd_accounts[device.id]
+            self.account_health.pop(device.id, None)
+            self.call_on_loop(self.unschedule_account, device.id)
 
         elif device.deviceTypeId == "cdVehicle":
             del self.cd_vehicles[device.address]
 
+        elif device.deviceTypeId == "cdZone":
+            self.call_on_loop(self.remove_zone, device.id)
+
+    def device_deleted(self, device):
+        super().device_deleted(device)
+        if device.deviceTypeId == "cdAccount":
+            self.call_on_loop(self.forget_account_vehicles, device.id)
+            self.call_on_loop(self.request_cache_save)
+
+    def action_control_universal(self, action, device):
+        if action.deviceAction == indigo.kUniversalAction.RequestStatus:
+            self.logger.debug(f"{device.name}: status request")
+            if device.deviceTypeId == "cdAccount":
+                self.request_update(device.id)
+            elif device.deviceTypeId == "cdVehicle":
+                self.call_on_loop(self.request_vehicle_refresh, device.address)
+
     async def get_account_data(self, account):
         self.logger.debug(f"get_account_data")
 
         try:
-            await account.get_vehicles()
+            with self.metrics.timer("api.get_vehicles"):
+                await account.get_vehicles()
+        except AUTH_ERRORS as e:
+            self.metrics.count(f"error.{type(e).__name__}")
+            self.logger.debug(f"get_account_data get_vehicles auth error: {e}")
+            if dev_id := next((dev_id for dev_id, a in self.cd_accounts.items() if a is account), None):
+                self.auth_incident(dev_id, e)
+            return None
         except Exception as e:
+            self.metrics.count(f"error.{type(e).__name__}")
             self.logger.warning(f"get_account_data get_vehicles error: {e}")
             return None
 
+        return self.account_tokens(account)
+
+    async def ensure_account_vehicles(self, account_dev_id):
+        """
+        After a warm start the vehicles come from the cache, and the account only knows them once
+        get_vehicles has run.  List them now instead of failing until the first scheduled poll.
+        Returns False if that doesn't work.
+        """
+        cd_account = self.cd_accounts[account_dev_id]
+        if cd_account.vehicles:
+            return True
+        self.logger.debug(f"Account {account_dev_id}: listing vehicles ahead of the first poll")
+        if not await self.get_account_data(cd_account):
+            return False
+        self.record_tokens(account_dev_id)
+        return True
+
+    @staticmethod
+    def account_tokens(account):
         return {
             "refresh_token": account.config.authentication.refresh_token,
             "gcid": account.config.authentication.gcid,
             "access_token": account.config.authentication.access_token,
         }
 
+    ########################################
+    # Metrics and profiling
+    ########################################
+
+    async def loop_lag_monitor(self):
+        # how late the loop wakes us up is how long other work kept it busy
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.metrics.observe("loop.lag", max(0.0, time.perf_counter() - start - LOOP_LAG_INTERVAL))
+
+    def report_profile(self, profiler):
+        path = os.path.join(self.data_folder, PROFILE_FILE)
+        profiler.dump_stats(path)
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(25)
+        self.logger.info(f"Profile of account update saved to {path}\n{output.getvalue()}")
+
+    def fetch_metrics_action(self, action, device, callerWaitingForResult):
+        return json.dumps(self.metrics.snapshot())
+
+    def menu_log_metrics(self):
+        self.logger.info(f"Plugin metrics:\n{json.dumps(self.metrics.snapshot(), indent=4)}")
+        return True
+
+    def menu_reset_metrics(self):
+        self.metrics.reset()
+        self.logger.info("Plugin metrics reset")
+        return True
+
+    def menu_profile_next_update(self):
+        self.profile_next_update = True
+        self.request_update()
+        self.logger.info("Profiling the next account update")
+        return True
+
+    ########################################
+    # Token management
+    ########################################
+
+    async def token_refresher(self):
+        # refresh access tokens ahead of expiry, so a poll never starts with an expired token
+        while True:
+            now = time.time()
+            wake_at = now + TOKEN_CHECK_INTERVAL
+            refreshes = []
+            for dev_id, account in list(self.cd_accounts.items()):
+                state = self.token_state.get(dev_id)
+                expires_at = account.config.authentication.expires_at
+                if not state or not expires_at:
+                    continue
+                refresh_at = max(expires_at.timestamp() - TOKEN_REFRESH_MARGIN, state['retry_at'])
+                if refresh_at > now:
+                    wake_at = min(wake_at, refresh_at)
+                    continue
+                refreshes.append(self.refresh_account_token(dev_id, account, expires_at))
+
+            # side by side, so one account whose login hangs doesn't hold up the others
+            if refreshes:
+                await asyncio.gather(*refreshes)
+            await asyncio.sleep(max(1.0, wake_at - time.time()))
+
+    async def refresh_account_token(self, dev_id, account, expires_at):
+        authentication = account.config.authentication
+        state = self.token_state[dev_id]
+        try:
+            # bimmer_connected logs in under this lock when a request gets a 401, and the refresh token
+            # only works once, so never refresh at the same time as a poll does
+            async with authentication.login_lock:
+                if authentication.expires_at and authentication.expires_at > expires_at:
+                    self.logger.debug(f"token_refresher: account {dev_id} was refreshed while waiting")
+                else:
+                    await asyncio.wait_for(authentication.login(), timeout=self.account_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            state['failures'] += 1
+            state['retry_at'] = time.time() + min(TOKEN_RETRY_BASE * 2 ** (state['failures'] - 1), TOKEN_RETRY_MAX)
+            self.logger.debug(f"token_refresher: account {dev_id} refresh failed ({state['failures']}): {e!r}")
+            # network errors and timeouts only back off, the next attempt will probably work
+            if isinstance(e, AUTH_ERRORS):
+                self.auth_incident(dev_id, e)
+        else:
+            self.record_tokens(dev_id)
+
+    def record_tokens(self, dev_id):
+        """
+        Called on the event loop after a successful login or poll.  Only writes prefs and account
+        states when the tokens actually changed, and saves prefs once for a burst of changes.
+        """
+        account = self.cd_accounts.get(dev_id)
+        state = self.token_state.get(dev_id)
+        if not account or not state:
+            return
+        state['failures'] = 0
+        state['retry_at'] = 0.0
+        if state['incident']:
+            self.logger.info(f"Account {dev_id}: authorization restored")
+            state['incident'] = False
+
+        tokens = self.account_tokens(account)
+        if tokens == state['tokens']:
+            return
+        state['tokens'] = tokens
+
+        if account_dev := indigo.devices.get(int(dev_id)):
+            self.update_changed_states(account_dev, [{'key': 'refresh_token', 'value': tokens['refresh_token']},
+                                                     {'key': 'gcid', 'value': tokens['gcid']},
+                                                     {'key': 'auth_token', 'value': tokens['access_token']}])
+        self.pluginPrefs[AUTH_TOKEN_PLUGIN_PREF.format(dev_id)] = json.dumps(tokens)
+        self.request_prefs_save()
+
+    def request_prefs_save(self):
+        # event loop only
+        if not self.prefs_save_handle:
+            self.prefs_save_handle = self.event_loop.call_later(PREFS_SAVE_DELAY, self.save_prefs)
+
+    def save_prefs(self):
+        self.prefs_save_handle = None
+        self.cache_save_handle = None
+        self.data_age_handle = None     # timer for the next stale or data_age change, and when it is due
+        self.data_age_due = None
+        self.logger.debug("save_prefs: saving updated plugin prefs")
+        self.savePluginPrefs()
+
+    def auth_incident(self, dev_id, error):
+        # fire auth_error once when an account's auth starts failing, not on every retry or poll
+        state = self.token_state.get(dev_id)
+        if not state or state['incident']:
+            return
+        state['incident'] = True
+        self.logger.warning(f"Account {dev_id}: authorization error: {error}")
+        for trigger in indigo.triggers.iter("self"):
+            if trigger.pluginTypeId == "auth_error":
+                indigo.trigger.execute(trigger)
+
     async def do_account_update(self, account_dev_id):
         account_dev = indigo.devices[int(account_dev_id)]
         self.logger.debug(f"{account_dev.name}: do_account_update")
@@ -272,119 +954,338 @@ class Plugin(indigo.PluginBase):
         cd_account = self.cd_accounts[account_dev_id]
         auth_data = await self.get_account_data(cd_account)
         if not auth_data:
+            return False
+
+        self.record_tokens(account_dev_id)
+
+        self.update_geofences(cd_account.vehicles)
+
+        poll_intervals = []
+        for vehicle in cd_account.vehicles:
+            poll_intervals.append(self.update_vehicle(account_dev, vehicle))
+        self.request_cache_save()
+        self.history.flush()
+
+        # the account is polled as often as its most demanding vehicle needs
+        if poll_intervals:
+            self.schedule_account(account_dev_id, time.time() + self.jittered(min(poll_intervals)))
+
+        self.logger.debug(f"{account_dev.name}: states written = {self.states_written}, states skipped = {self.states_skipped}")
+        return True
+
+    def request_vehicle_refresh(self, vin):
+        # runs on the event loop
+        if vin in self.vehicle_tasks:
             return
+        if vin not in self.vehicle_data:
+            self.schedule_all_accounts()    # not fetched yet, so the whole account has to be
+            return
+        account_dev_id = self.vehicle_data[vin].account
+        if not (cd_account := self.cd_accounts.get(account_dev_id)):
+            return
+        health = self.account_health.get(account_dev_id)
+        if health and health['open']:
+            return                          # the account's next probe refreshes it
+        if not cd_account.get_vehicle(vin):
+            # only cached so far, the account has to list its vehicles before one can be refreshed
+            self.schedule_account(account_dev_id, time.time())
+            return
+        self.vehicle_tasks[vin] = self.event_loop.create_task(self.run_vehicle_update(vin))
 
-        self.logger.debug(f"{account_dev.name}: {auth_data=}")
+    async def run_vehicle_update(self, vin):
+        try:
+            await asyncio.wait_for(self.do_vehicle_update(vin), timeout=self.account_timeout)
+        except asyncio.TimeoutError:
+            self.metrics.count("error.TimeoutError")
+            self.logger.warning(f"run_vehicle_update: {vin} timed out after {self.account_timeout} seconds")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.metrics.count(f"error.{type(e).__name__}")
+            self.logger.warning(f"run_vehicle_update: {vin} error: {e}")
+        finally:
+            self.vehicle_tasks.pop(vin, None)
 
-        states_list = [{'key': 'refresh_token', 'value': auth_data['refresh_token']},
-                       {'key': 'gcid', 'value': auth_data['gcid']},
-                       {'key': 'auth_token', 'value': auth_data['access_token']}]
-        account_dev.updateStatesOnServer(states_list)
+    async def do_vehicle_update(self, vin):
+        account_dev_id = self.vehicle_data[vin].account
+        account_dev = indigo.devices[int(account_dev_id)]
+        self.logger.debug(f"{account_dev.name}: do_vehicle_update for {vin}")
 
-        self.pluginPrefs[AUTH_TOKEN_PLUGIN_PREF.format(account_dev_id)] = json.dumps(auth_data)
-        self.savePluginPrefs()
+        vehicle = self.cd_accounts[account_dev_id].get_vehicle(vin)
+        if not vehicle:
+            self.logger.debug(f"{account_dev.name}: do_vehicle_update: {vin} not listed yet, updating the account instead")
+            self.schedule_account(account_dev_id, time.time())
+            return
 
-        for vehicle in cd_account.vehicles:
+        # fetch state for just this vehicle, not the whole account
+        with self.metrics.timer("api.get_vehicle_state"):
+            await vehicle.get_vehicle_state()
+        # a 401 during the fetch makes bimmer_connected log in again, and the new tokens have to be saved
+        self.record_tokens(account_dev_id)
+        self.update_geofences([vehicle])
+        poll_interval = self.update_vehicle(account_dev, vehicle)
+        self.request_cache_save()
+        self.history.flush()
+
+        # never push the account's next poll later, only earlier if this vehicle now needs it
+        next_update = time.time() + poll_interval
+        if next_update < self.account_next_update.get(account_dev_id, next_update):
+            self.schedule_account(account_dev_id, next_update)
+
+    def update_vehicle(self, account_dev, vehicle):
+        """
+        Save the snapshot for one vehicle and push its states to the matching Indigo device.
+        Returns the poll interval this vehicle wants.
+        """
+        # serialize the vehicle once for this poll and save it
+        with self.metrics.timer("phase.serialize"):
+            self.vehicle_data[vehicle.vin] = VehicleSnapshot.from_vehicle(account_dev.id, vehicle)
+        self.publish_changes(vehicle.vin)
+
+        sample = self.vehicle_sample(vehicle)
+        self.history.record(vehicle.vin, sample)
+        self.update_sessions(vehicle, sample)
+        poll_interval, poll_reason = self.compute_poll_interval(vehicle)
+
+        # look for an Indigo device that matches this vehicle
+        vehicleDevID = self.cd_vehicles.get(vehicle.vin)
+        if not vehicleDevID:
+            self.logger.debug(f"{account_dev.name}: VIN not found: {vehicle.vin}")
+            return poll_interval
+
+        vehicleDevice = indigo.devices.get(int(vehicleDevID))
+        if not vehicleDevice:
+            self.logger.debug(f"{account_dev.name}: Indigo device for vehicleDevID not found: {vehicleDevID}")
+            return poll_interval
+
+        self.logger.debug(f"{account_dev.name}: Updating {vehicle.name} ({vehicle.vin}) -->  {vehicleDevice.name} ({vehicleDevice.id})")
+        convert_start = time.perf_counter()
+
+        distance = self.geofence.distance(vehicle.vin, HOME_ZONE) or 0.0
+
+        fuel_percent, fuel_percent_ui = self.units.percent(vehicle.fuel_and_battery.remaining_fuel_percent)
+        battery_percent, battery_percent_ui = self.units.percent(vehicle.fuel_and_battery.remaining_battery_percent)
+
+        states_list = [{'key': 'vin', 'value': vehicle.vin},
+                       {'key': 'brand', 'value': vehicle.brand},
+                       {'key': 'driveTrain', 'value': vehicle.drive_train},
+                       {'key': 'is_vehicle_active', 'value': vehicle.is_vehicle_active},
+                       {'key': 'timestamp', 'value': vehicle.timestamp.replace(tzinfo=datetime.timezone.utc).astimezone().strftime("%d %b %Y %H:%M:%S %Z")},
+                       {'key': 'model', 'value': vehicle.data['attributes']['model']},
+                       {'key': 'year', 'value': vehicle.data['attributes']['year']},
+                       {'key': 'all_lids_closed', 'value': vehicle.doors_and_windows.all_lids_closed},
+                       {'key': 'all_windows_closed', 'value': vehicle.doors_and_windows.all_windows_closed},
+                       {'key': 'door_lock_state', 'value': vehicle.doors_and_windows.door_lock_state},
+                       {'key': 'is_charger_connected', 'value': vehicle.fuel_and_battery.is_charger_connected},
+                       {'key': 'remaining_fuel_percent', 'value': fuel_percent, 'uiValue': fuel_percent_ui},
+                       {'key': 'remaining_battery_percent', 'value': battery_percent, 'uiValue': battery_percent_ui},
+                       {'key': 'last_update', 'value': time.strftime("%d %b %Y %H:%M:%S %Z")},
+                       {'key': 'poll_interval', 'value': round(poll_interval / 60.0, 1), 'uiValue': f"{poll_interval / 60.0:.1f} min"},
+                       {'key': 'poll_reason', 'value': poll_reason},
+                       ] + self.data_age_states(vehicle.vin)
+
+        mileage, mileage_ui = self.units.mileage(vehicle.mileage[0], vehicle.mileage[1])
+        states_list.append({'key': 'mileage', 'value': mileage, 'uiValue': mileage_ui})
+        fuel, fuel_ui = self.units.fuel(vehicle.fuel_and_battery.remaining_fuel.value)
+        states_list.append({'key': 'remaining_fuel', 'value': fuel, 'uiValue': fuel_ui})
+        remaining_range, remaining_range_ui = self.units.range(vehicle.fuel_and_battery.remaining_range_total.value)
+        states_list.append({'key': 'remaining_range_total', 'value': remaining_range, 'uiValue': remaining_range_ui})
+        distance, distance_ui = self.units.distance(distance)
+        states_list.append({'key': 'distance', 'value': distance, 'uiValue': distance_ui})
+        states_list.append({'key': 'zones', 'value': ", ".join(self.geofence.zone_names(vehicle.vin))})
+
+        if trip := self.sessions.last_trip(vehicle.vin):
+            trip_distance, trip_distance_ui = self.units.distance(trip['distance'] or 0.0)
+            states_list.append({'key': 'last_trip_distance', 'value': trip_distance, 'uiValue': trip_distance_ui})
+            trip_speed, trip_speed_ui = self.units.speed(trip['average_speed'] or 0.0)
+            states_list.append({'key': 'last_trip_average_speed', 'value': trip_speed, 'uiValue': trip_speed_ui})
+        if charge := self.sessions.last_charge(vehicle.vin):
+            charge_added, charge_added_ui = self.units.percent(charge['battery_added'] or 0)
+            states_list.append({'key': 'last_charge_added', 'value': charge_added, 'uiValue': charge_added_ui})
+
+        if vehicle.vehicle_location and vehicle.vehicle_location.location:
+            states_list.append({'key': 'gps_lat', 'value': vehicle.vehicle_location.location.latitude})
+            states_list.append({'key': 'gps_long', 'value': vehicle.vehicle_location.location.longitude})
+            states_list.append({'key': 'gps_heading', 'value': vehicle.vehicle_location.heading})
+
+        open_lid_list = ""
+        if not vehicle.doors_and_windows.all_lids_closed:
+            open_lid_list = ", ".join(lid.name for lid in vehicle.doors_and_windows.open_lids)
+        states_list.append({'key': 'open_lids', 'value': open_lid_list})
+
+        open_window_list = ""
+        if not vehicle.doors_and_windows.all_windows_closed:
+            open_window_list = ", ".join(window.name for window in vehicle.doors_and_windows.open_windows)
+        states_list.append({'key': 'open_windows', 'value': open_window_list})
+
+        status_value = ""
+        status_ui = ""
+        for state in states_list:
+            if state['key'] == vehicleDevice.pluginProps["state_key"]:
+                status_value = state['value']
+                status_ui = state.get('uiValue', status_value)
+                break
+        states_list.append({'key': 'status', 'value': status_value, 'uiValue': status_ui})
+        self.metrics.observe("phase.convert", time.perf_counter() - convert_start)
 
-            # convert vehicle data to a pure Python dict and save it
-            self.vehicle_data[vehicle.vin] = {'account': account_dev_id, 'vehicle': json.loads(json.dumps(vehicle, cls=MyBMWJSONEncoder))}
+        with self.metrics.timer("phase.state_push"):
+            self.update_changed_states(vehicleDevice, states_list, heartbeat_key='last_update')
+        self.schedule_data_age_check(self.next_data_age_change(vehicle.vin))
 
-            # look for an Indigo device that matches this vehicle
-            vehicleDevID = self.cd_vehicles.get(vehicle.vin)
-            if not vehicleDevID:
-                self.logger.debug(f"{account_dev.name}: VIN not found: {vehicle.vin}")
-                continue
+        return poll_interval
 
-            vehicleDevice = indigo.devices.get(int(vehicleDevID))
-            if not vehicleDevice:
-                self.logger.debug(f"{account_dev.name}: Indigo device for vehicleDevID not found: {vehicleDevID}")
-                continue
+    def publish_changes(self, vin):
+        # push each subscriber the fields that changed in this poll, the snapshot is only decoded if someone is listening
+        if not self.subscriptions.any_for(vin):
+            return
+        snapshot = self.vehicle_data[vin]
+        for subscriber, changed in self.subscriptions.changes(vin, snapshot.vehicle):
+            self.metrics.count("subscriptions.pushed")
+            indigo.server.broadcastToSubscribers(VEHICLE_UPDATE_BROADCAST, json.dumps(
+                {'subscriber': subscriber, 'vin': vin, 'fetched': snapshot.fetched, 'fields': changed}))
 
-            self.logger.debug(f"{account_dev.name}: Updating {vehicle.name} ({vehicle.vin}) -->  {vehicleDevice.name} ({vehicleDevice.id})")
+    @staticmethod
+    def vehicle_sample(vehicle):
+        # the raw values (API units) that history and session detection work from
+        location = vehicle.vehicle_location.location if vehicle.vehicle_location else None
+        return {
+            'ts': vehicle.timestamp.replace(tzinfo=datetime.timezone.utc).timestamp(),
+            'mileage': vehicle.mileage[0],
+            'fuel': vehicle.fuel_and_battery.remaining_fuel.value,
+            'battery': vehicle.fuel_and_battery.remaining_battery_percent,
+            'range': vehicle.fuel_and_battery.remaining_range_total.value,
+            'lat': location.latitude if location else None,
+            'lon': location.longitude if location else None,
+            'charging': vehicle.fuel_and_battery.is_charger_connected,
+            'active': vehicle.is_vehicle_active,
+        }
 
-            try:
-                (latitude, longitude) = indigo.server.getLatitudeAndLongitude()
-                distance = haversine(longitude, latitude, vehicle.vehicle_location.location.longitude, vehicle.vehicle_location.location.latitude)
-            except (Exception,):
-                distance = 0.0
-
-            fuel_percent = vehicle.fuel_and_battery.remaining_fuel_percent
-            fuel_percent_ui = f"{fuel_percent} %" if fuel_percent else ""
-            battery_percent = vehicle.fuel_and_battery.remaining_battery_percent
-            battery_percent_ui = f"{battery_percent} %" if battery_percent else ""
-
-            states_list = [{'key': 'vin', 'value': vehicle.vin},
-                           {'key': 'brand', 'value': vehicle.brand},
-                           {'key': 'driveTrain', 'value': vehicle.drive_train},
-                           {'key': 'is_vehicle_active', 'value': vehicle.is_vehicle_active},
-                           {'key': 'timestamp', 'value': vehicle.timestamp.replace(tzinfo=datetime.timezone.utc).astimezone().strftime("%d %b %Y %H:%M:%S %Z")},
-                           {'key': 'model', 'value': vehicle.data['attributes']['model']},
-                           {'key': 'year', 'value': vehicle.data['attributes']['year']},
-                           {'key': 'all_lids_closed', 'value': vehicle.doors_and_windows.all_lids_closed},
-                           {'key': 'all_windows_closed', 'value': vehicle.doors_and_windows.all_windows_closed},
-                           {'key': 'open_windows', 'value': ""},
-                           {'key': 'door_lock_state', 'value': vehicle.doors_and_windows.door_lock_state},
-                           {'key': 'is_charger_connected', 'value': vehicle.fuel_and_battery.is_charger_connected},
-                           {'key': 'remaining_fuel_percent', 'value': fuel_percent, 'uiValue': fuel_percent_ui},
-                           {'key': 'remaining_battery_percent', 'value': battery_percent, 'uiValue': battery_percent_ui},
-                           {'key': 'last_update', 'value': time.strftime("%d %b %Y %H:%M:%S %Z")},
-                           ]
-
-            if self.units == "metric":  # use API results directly
-                states_list.append({'key': 'mileage', 'value': vehicle.mileage[0],
-                                    'uiValue': f"{vehicle.mileage[0]} {vehicle.mileage[1]}"})
-                states_list.append({'key': 'remaining_fuel', 'value': vehicle.fuel_and_battery.remaining_fuel.value,
-                                    'uiValue': f"{vehicle.fuel_and_battery.remaining_fuel.value} L"})
-                states_list.append({'key': 'remaining_range_total', 'value': vehicle.fuel_and_battery.remaining_range_total.value,
-                                   'uiValue': f"{vehicle.fuel_and_battery.remaining_range_total.value} km"})
-                states_list.append({'key': 'distance', 'value': distance,
-                                    'uiValue': f"{distance} km"})
-
-            else:                        # convert to US units
-                mileage = (vehicle.mileage[0] * self.ureg.kilometer).to(self.ureg.miles)
-                states_list.append({'key': 'mileage', 'value': int(mileage.magnitude), 'uiValue': f"{int(mileage.magnitude)} mi"})
-
-                fuel = (vehicle.fuel_and_battery.remaining_fuel.value * self.ureg.liter).to(self.ureg.gallon)
-                states_list.append({'key': 'remaining_fuel', 'value': float(fuel.magnitude), 'uiValue': f"{fuel.magnitude:.1f} gal"})
-
-                range = (vehicle.fuel_and_battery.remaining_range_total.value * self.ureg.kilometer).to(self.ureg.miles)
-                states_list.append({'key': 'remaining_range_total', 'value': int(range.magnitude), 'uiValue': f"{int(range.magnitude)} mi"})
-
-                distance = (distance * self.ureg.kilometer).to(self.ureg.miles)
-                states_list.append({'key': 'distance', 'value': float(distance.magnitude), 'uiValue': f"{distance.magnitude:.2f} mi"})
-
-            if vehicle.vehicle_location:
-                states_list.append({'key': 'gps_lat', 'value': vehicle.vehicle_location.location.latitude})
-                states_list.append({'key': 'gps_long', 'value': vehicle.vehicle_location.location.longitude})
-                states_list.append({'key': 'gps_heading', 'value': vehicle.vehicle_location.heading})
-
-            open_lid_list = ""
-            if not vehicle.doors_and_windows.all_lids_closed:
-                open_lid_list = ", ".join(lid.name for lid in vehicle.doors_and_windows.open_lids)
-            states_list.append({'key': 'open_lids', 'value': open_lid_list})
-
-            open_window_list = ""
-            if not vehicle.doors_and_windows.all_windows_closed:
-                open_window_list = ", ".join(window.name for window in vehicle.doors_and_windows.open_windows)
-            states_list.append({'key': 'open_windows', 'value': open_window_list})
-
-            status_value = ""
-            status_ui = ""
-            for state in states_list:
-                if state['key'] == vehicleDevice.pluginProps["state_key"]:
-                    status_value = state['value']
-                    status_ui = state.get('uiValue', status_value)
-                    break
-            states_list.append({'key': 'status', 'value': status_value, 'uiValue': status_ui})
-
-            vehicleDevice.updateStatesOnServer(states_list)
+    def update_sessions(self, vehicle, sample):
+        for kind, session in self.sessions.process(vehicle.vin, sample):
+            if kind == "trip":
+                self.logger.info(f"{vehicle.name}: trip ended, {session['distance']} km in {session['duration'] / 60.0:.0f} minutes")
+                event = "trip_ended"
+            else:
+                self.logger.info(f"{vehicle.name}: charging complete, {session['battery_added']}% added in {session['duration'] / 60.0:.0f} minutes")
+                event = "charging_complete"
+            for trigger in indigo.triggers.iter("self"):
+                if trigger.pluginTypeId == event and trigger.pluginProps.get("vehicle") in (vehicle.vin, "any"):
+                    indigo.trigger.execute(trigger)
+
+    def refresh_home_zone(self):
+        # the server's location rarely changes, so only ask for it every HOME_LOCATION_TTL
+        if time.time() - self.home_location_time < HOME_LOCATION_TTL:
+            return
+        try:
+            (latitude, longitude) = indigo.server.getLatitudeAndLongitude()
+        except Exception as e:
+            self.logger.debug(f"refresh_home_zone: unable to get server location: {e}")
+            return
+        self.home_location_time = time.time()
+        self.geofence.set_zone(HOME_ZONE, "Home", latitude, longitude, self.home_radius)
+
+    def add_zone(self, dev_id, name, latitude, longitude, radius):
+        # event loop only
+        self.cd_zones[str(dev_id)] = dev_id
+        self.geofence.set_zone(str(dev_id), name, latitude, longitude, radius)
+
+    def remove_zone(self, dev_id):
+        # event loop only
+        self.cd_zones.pop(str(dev_id), None)
+        self.geofence.remove_zone(str(dev_id))
+
+    def update_geofences(self, vehicles):
+        self.refresh_home_zone()
+
+        positions = {}
+        for vehicle in vehicles:
+            if vehicle.vehicle_location and vehicle.vehicle_location.location:
+                positions[vehicle.vin] = (vehicle.vehicle_location.location.latitude, vehicle.vehicle_location.location.longitude)
+        if not positions:
+            return
+
+        transitions = self.geofence.evaluate(positions)
+        for vin, zone, transition in transitions:
+            self.logger.info(f"{vin}: {transition} zone {zone.name}")
+            for trigger in indigo.triggers.iter("self"):
+                if trigger.pluginTypeId != f"zone_{transition}":
+                    continue
+                if trigger.pluginProps.get("zone") not in (zone.zone_id, "any"):
+                    continue
+                if trigger.pluginProps.get("vehicle") not in (vin, "any"):
+                    continue
+                indigo.trigger.execute(trigger)
+
+        for zone_id, zoneDevID in self.cd_zones.items():
+            if zoneDevice := indigo.devices.get(zoneDevID):
+                vins = self.geofence.vehicles_in(zone_id)
+                self.update_changed_states(zoneDevice, [{'key': 'vehicles_inside', 'value': ", ".join(vins)},
+                                                        {'key': 'vehicle_count', 'value': len(vins)}])
+
+    def compute_poll_interval(self, vehicle):
+        """
+        Pick the next poll interval for a vehicle from its current activity.
+        Returns (interval in seconds, reason).
+        """
+        previous = self.vehicle_poll.get(vehicle.vin, {})
+        battery = vehicle.fuel_and_battery.remaining_battery_percent
+        last_battery = previous.get('battery')
+
+        if vehicle.is_vehicle_active:
+            interval, reason = ACTIVE_POLL_INTERVAL, "active"
+        elif vehicle.fuel_and_battery.is_charger_connected and battery is not None and last_battery is not None and battery > last_battery:
+            interval, reason = CHARGING_POLL_INTERVAL, "charging"
+        elif vehicle.doors_and_windows.door_lock_state in (LockState.LOCKED, LockState.SECURED):
+            # back off exponentially while the car sits parked and locked
+            if previous.get('reason') == "parked":
+                interval = min(previous['interval'] * 2.0, PARKED_POLL_CEILING)
+            else:
+                interval = self.updateFrequency
+            reason = "parked"
+        else:
+            interval, reason = self.updateFrequency, "normal"
+
+        self.vehicle_poll[vehicle.vin] = {'interval': interval, 'reason': reason, 'battery': battery}
+        self.logger.debug(f"{vehicle.name}: poll interval {interval} seconds ({reason})")
+        return interval, reason
+
+    def update_changed_states(self, device, states_list, heartbeat_key=None):
+        """
+        Push only the states whose value or uiValue differ from what was last sent for this device.
+        The heartbeat state goes out along with any other change, or by itself every HEARTBEAT_INTERVAL.
+        """
+        cache = self.state_cache.setdefault(device.id, {})
+        changed = []
+        heartbeat = None
+        for state in states_list:
+            if state['key'] == heartbeat_key:
+                heartbeat = state
+                continue
+            current = (state['value'], state.get('uiValue'))
+            if cache.get(state['key']) != current:
+                cache[state['key']] = current
+                changed.append(state)
+
+        if heartbeat:
+            now = time.time()
+            if changed or now - self.heartbeat_times.get(device.id, 0.0) >= HEARTBEAT_INTERVAL:
+                self.heartbeat_times[device.id] = now
+                changed.append(heartbeat)
+
+        self.states_written += len(changed)
+        self.states_skipped += len(states_list) - len(changed)
+        if changed:
+            self.metrics.count("indigo.updateStatesOnServer")
+            self.metrics.observe("indigo.updateStatesOnServer.states", len(changed), buckets=SIZE_BUCKETS)
+            device.updateStatesOnServer(changed)
+        return len(changed)
 
     def get_vehicle_list(self, filter="", valuesDict=None, typeId="", targetId=0):
         self.logger.threaddebug(f"get_vehicle_list: typeId = {typeId}, targetId = {targetId}, valuesDict = {valuesDict}")
         retList = []
 
         for v in self.vehicle_data.values():
-            retList.append((v['vehicle']['vin'], f"{v['vehicle']['data']['attributes']['year']} {v['vehicle']['data']['attributes']['model']}"))
+            retList.append((v.vehicle['vin'], f"{v.vehicle['data']['attributes']['year']} {v.vehicle['data']['attributes']['model']}"))
         retList.sort(key=lambda tup: tup[1])
         return retList
 
@@ -396,6 +1297,15 @@ class Plugin(indigo.PluginBase):
         retList.sort(key=lambda tup: tup[1])
         return retList
 
+    def get_zone_list(self, filter="", valuesDict=None, typeId="", targetId=0):
+        # a copy, the event loop may be adding or removing zones
+        retList = [(zone_id, zone.name) for zone_id, zone in list(self.geofence.zones.items()) if zone_id != HOME_ZONE]
+        retList.sort(key=lambda tup: tup[1])
+        return [("any", "Any Zone"), (HOME_ZONE, "Home")] + retList
+
+    def get_vehicle_filter_list(self, filter="", valuesDict=None, typeId="", targetId=0):
+        return [("any", "Any Vehicle")] + self.get_vehicle_list(filter, valuesDict, typeId, targetId)
+
     # doesn't do anything, just needed to force other menus to dynamically refresh
     @staticmethod
     def menu_changed(valuesDict=None, typeId=None, devId=None):
@@ -404,29 +1314,252 @@ class Plugin(indigo.PluginBase):
     def fetch_vehicle_data_action(self, action, device, callerWaitingForResult):
         vin = action.props["vin"]
         try:
-            return json.dumps(self.vehicle_data[vin])
+            age, stale = self.vehicle_data_age(vin)
+            if fields := self.prop_list(action.props.get("fields")):
+                snapshot = self.vehicle_data[vin]
+                return json.dumps({'account': snapshot.account, 'fetched': snapshot.fetched, 'reported': snapshot.reported,
+                                   'cached': snapshot.cached, 'age': age, 'stale': stale, 'fields': select_fields(snapshot.vehicle, fields)})
+            return self.vehicle_data[vin].to_json(age=age, stale=stale)
         except (Exception,):
             return json.dumps({})
 
+    @staticmethod
+    def prop_list(value):
+        # list props can come from a script as a list or a comma separated string
+        if not value:
+            return []
+        if isinstance(value, str):
+            return [item.strip() for item in value.split(",") if item.strip()]
+        return list(value)
+
+    def subscribe_action(self, action, device, callerWaitingForResult):
+        subscriber = action.props["subscriber"]
+        vins = self.prop_list(action.props.get("vins"))
+        fields = self.prop_list(action.props.get("fields"))
+        current = {vin: snapshot.vehicle for vin, snapshot in list(self.vehicle_data.items())}
+        initial = self.subscriptions.subscribe(subscriber, vins, fields, current)
+        self.logger.debug(f"subscribe_action: {subscriber} for {vins or 'all vehicles'}, {len(fields) or 'all'} fields")
+        self.save_subscriptions()
+        return json.dumps({'subscriber': subscriber, 'messageType': VEHICLE_UPDATE_BROADCAST, 'vehicles': initial})
+
+    def unsubscribe_action(self, action, device, callerWaitingForResult):
+        removed = self.subscriptions.unsubscribe(action.props["subscriber"])
+        if removed:
+            self.save_subscriptions()
+        return json.dumps({'subscriber': action.props["subscriber"], 'removed': removed})
+
+    def save_subscriptions(self):
+        self.pluginPrefs[SUBSCRIPTIONS_PLUGIN_PREF] = json.dumps(self.subscriptions.as_list())
+        self.call_on_loop(self.request_prefs_save)
+
+    def query_history_action(self, action, device, callerWaitingForResult):
+        try:
+            return json.dumps(self.history.samples(action.props["vin"], float(action.props.get("hours", 24))))
+        except Exception as e:
+            self.logger.warning(f"query_history_action error: {e}")
+            return json.dumps([])
+
+    def query_daily_history_action(self, action, device, callerWaitingForResult):
+        try:
+            return json.dumps(self.history.daily(action.props["vin"], int(action.props.get("days", 7))))
+        except Exception as e:
+            self.logger.warning(f"query_daily_history_action error: {e}")
+            return json.dumps([])
+
+    def fetch_sessions_action(self, action, device, callerWaitingForResult):
+        return json.dumps(self.sessions.recent(action.props["vin"]))
+
     def menu_dump_vehicles(self):
         for vin in self.vehicle_data:
             self.logger.info(
-                f"Data for VIN {vin}:\n{json.dumps(self.vehicle_data[vin], skipkeys=True, sort_keys=True, indent=4, separators=(',', ': '))}")
+                f"Data for VIN {vin}:\n{json.dumps(self.vehicle_data[vin].as_dict(), skipkeys=True, sort_keys=True, indent=4, separators=(',', ': '))}")
+        return True
+
+    def menu_record_fixtures(self):
+        # save each vehicle's encoded snapshot with its VIN replaced, for replaying against a stub API
+        folder = os.path.join(self.data_folder, FIXTURES_FOLDER)
+        os.makedirs(folder, exist_ok=True)
+        for index, (vin, snapshot) in enumerate(sorted(self.vehicle_data.items())):
+            fixture_vin = f"TESTVIN{index:010d}"
+            with open(os.path.join(folder, f"{fixture_vin}.json"), "w") as f:
+                f.write(snapshot.encoded.replace(vin, fixture_vin))
+        self.logger.info(f"Wrote {len(self.vehicle_data)} vehicle fixtures to {folder} (VINs replaced, GPS positions are not)")
+        return True
+
+    def menu_verify_units(self):
+        if mismatches := verify_with_pint():
+            for name, ours, theirs in mismatches:
+                self.logger.warning(f"Unit conversion {name}: plugin factor {ours} does not match pint {theirs}")
+        else:
+            self.logger.info("Unit conversions match pint")
         return True
 
     def send_command_action(self, plugin_action, vehicle_device, callerWaitingForResult):
         self.logger.debug(f"{vehicle_device.name}: send_command_action {plugin_action.props['serviceCode']} for VIN {vehicle_device.address}")
-        cd_account_device = indigo.devices[int(self.vehicle_data[vehicle_device.address]['account'])]
+        cd_account_device = indigo.devices[int(self.vehicle_data[vehicle_device.address].account)]
         self.logger.debug(f"{vehicle_device.name}: send_command_action using cd_account_device: {cd_account_device.name}")
 
-        self.event_loop.create_task(self.async_send_command_action(cd_account_device, vehicle_device.address, plugin_action))
+        command = {'service': plugin_action.props['serviceCode'], 'action': plugin_action, 'account': cd_account_device, 'queued': time.time()}
+        if not self.call_on_loop(self.enqueue_command, vehicle_device.address, command):
+            self.logger.warning(f"{vehicle_device.name}: plugin is shutting down, {command['service']} not sent")
+
+    def enqueue_command(self, vin, command):
+        queue = self.command_queues.setdefault(vin, [])
+        group = COMMAND_GROUPS.get(command['service'])
+        for index, pending in enumerate(queue):
+            if group and COMMAND_GROUPS.get(pending['service']) == group:
+                self.logger.debug(f"{vin}: {command['service']} supersedes queued {pending['service']}")
+                self.resolve_command(pending, "SUPERSEDED")
+                queue[index] = command
+                break
+        else:
+            queue.append(command)
+
+        self.update_command_states(vin, [{'key': 'command_queue_depth', 'value': len(queue)}])
+        if vin not in self.command_workers:
+            self.command_workers[vin] = self.event_loop.create_task(self.run_command_queue(vin))
 
-        # schedule an update shortly
-        self.next_update = time.time() + 30.0
+    async def run_command_queue(self, vin):
+        # commands for one vehicle run one at a time, in order
+        queue = self.command_queues[vin]
+        account_dev_id = None
+        command = None
+        try:
+            await asyncio.sleep(COMMAND_COALESCE_DELAY)
+            while queue:
+                command = queue.pop(0)
+                account_dev_id = command['account'].id
+                started = time.time()
+                self.update_command_states(vin, [{'key': 'command_queue_depth', 'value': len(queue)},
+                                                 {'key': 'last_command', 'value': command['service']},
+                                                 {'key': 'last_command_state', 'value': "PENDING"}])
+                error = None
+                try:
+                    with self.metrics.timer(f"api.remote_service.{command['service']}"):
+                        state = await self.async_send_command_action(command['account'], vin, command['action']) or "ERROR"
+                except Exception as e:
+                    self.metrics.count(f"error.{type(e).__name__}")
+                    self.logger.warning(f"{vin}: {command['service']} command error: {e}")
+                    state = "ERROR"
+                    error = e
+                self.resolve_command(command, state, error)
+
+                wait = started - command['queued']
+                latency = time.time() - command['queued']
+                self.logger.debug(f"{vin}: {command['service']} finished with {state}, queue wait {wait:.1f}s, latency {latency:.1f}s, queue depth {len(queue)}")
+                self.update_command_states(vin, [{'key': 'last_command_state', 'value': state},
+                                                 {'key': 'last_command_wait', 'value': round(wait, 1), 'uiValue': f"{wait:.1f} sec"},
+                                                 {'key': 'last_command_latency', 'value': round(latency, 1), 'uiValue': f"{latency:.1f} sec"}])
+        finally:
+            del self.command_workers[vin]
+            # only left over if the worker was cancelled, anyone waiting on these must not wait forever
+            for pending in [command] + queue:
+                if pending:
+                    self.resolve_command(pending, "CANCELLED")
+            queue.clear()
+
+        # refresh just this vehicle once the queue has drained, rather than after every command
+        if account_dev_id in self.cd_accounts:
+            self.event_loop.call_later(COMMAND_REFRESH_DELAY, self.request_vehicle_refresh, vin)
+
+    @staticmethod
+    def resolve_command(command, state, error=None):
+        # tell a fleet command waiting on this one how it ended
+        if (future := command.get('future')) and not future.done():
+            future.set_result((state, error))
+
+    def fleet_command_action(self, plugin_action, device, callerWaitingForResult):
+        vins = self.select_fleet_vehicles(plugin_action.props)
+        self.logger.info(f"Fleet command {plugin_action.props['serviceCode']} for {len(vins)} vehicles")
+        try:
+            future = asyncio.run_coroutine_threadsafe(self.run_fleet_command(plugin_action, vins), self.event_loop)
+            if not callerWaitingForResult:
+                return None
+            return json.dumps(future.result(timeout=FLEET_COMMAND_TIMEOUT))
+        except (Exception, asyncio.CancelledError) as e:
+            self.logger.warning(f"fleet_command_action: no result: {e}")
+            return json.dumps({'service': plugin_action.props['serviceCode'], 'error': str(e)})
+
+    def select_fleet_vehicles(self, props):
+        vins = [vin for vin, snapshot in self.vehicle_data.items() if snapshot.account in self.cd_accounts]
+        match props.get("target", "all"):
+            case "selected":
+                selected = set(props.get("vehicles", []))
+                vins = [vin for vin in vins if vin in selected]
+            case "electric":
+                # from the snapshot, so cached vehicles match before their account's first poll
+                vins = [vin for vin in vins if self.vehicle_data[vin].vehicle.get('has_electric_drivetrain')]
+        return sorted(vins)
+
+    async def run_fleet_command(self, plugin_action, vins):
+        service = plugin_action.props['serviceCode']
+        started = time.time()
+        task = asyncio.current_task()
+        self.fleet_tasks.add(task)
+        try:
+            results = await asyncio.gather(*(self.run_fleet_vehicle(plugin_action, vin) for vin in vins))
+        finally:
+            self.fleet_tasks.discard(task)
+
+        succeeded = sum(1 for result in results if result['state'] == "EXECUTED")
+        summary = {'service': service, 'started': started, 'duration': round(time.time() - started, 1), 'executed': succeeded,
+                   'vehicles': dict(zip(vins, results))}
+        self.logger.info(f"Fleet command {service} finished: {succeeded} of {len(vins)} executed in {summary['duration']} seconds")
+        for vin, result in summary['vehicles'].items():
+            if result['state'] != "EXECUTED":
+                self.logger.info(f"    {vin}: {result['state']} after {result['attempts']} attempts {result['error'] or ''}")
+
+        self.last_fleet_result = summary
+        for trigger in indigo.triggers.iter("self"):
+            if trigger.pluginTypeId == "fleet_command_complete":
+                indigo.trigger.execute(trigger)
+        return summary
+
+    async def run_fleet_vehicle(self, plugin_action, vin):
+        """
+        Send one fleet command to one vehicle through its command queue, at most fleet_concurrency at a time
+        per account, retrying transient failures with a jittered backoff.
+        """
+        snapshot = self.vehicle_data.get(vin)
+        if not snapshot or snapshot.account not in self.cd_accounts:
+            return {'state': "NOT_FOUND", 'attempts': 0, 'error': None}
+        account_dev = indigo.devices[int(snapshot.account)]
+        limiter = self.fleet_limiters.setdefault(snapshot.account, asyncio.Semaphore(self.fleet_concurrency))
+
+        attempt = 0
+        while True:
+            attempt += 1
+            async with limiter:
+                # keep commands on one account spaced out, so a big fleet doesn't trip the API's rate limit
+                delay = self.fleet_last_start.get(snapshot.account, 0.0) + FLEET_COMMAND_SPACING - time.time()
+                self.fleet_last_start[snapshot.account] = time.time() + max(0.0, delay)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                future = self.event_loop.create_future()
+                self.enqueue_command(vin, {'service': plugin_action.props['serviceCode'], 'action': plugin_action,
+                                           'account': account_dev, 'queued': time.time(), 'future': future})
+                state, error = await future
+
+            transient = isinstance(error, (MyBMWQuotaError, httpx.TransportError, asyncio.TimeoutError))
+            if not transient or attempt > FLEET_RETRIES:
+                # an ExecutionState's str() is "ExecutionState.EXECUTED", keep the bare value like the other states
+                return {'state': getattr(state, "value", state), 'attempts': attempt, 'error': str(error) if error else None}
+            await asyncio.sleep(FLEET_RETRY_DELAY * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    def fetch_fleet_result_action(self, action, device, callerWaitingForResult):
+        return json.dumps(self.last_fleet_result or {})
+
+    def update_command_states(self, vin, states_list):
+        vehicleDevID = self.cd_vehicles.get(vin)
+        if vehicleDevID and (vehicleDevice := indigo.devices.get(int(vehicleDevID))):
+            self.update_changed_states(vehicleDevice, states_list)
 
     async def async_send_command_action(self, cd_account_device, vin, plugin_action):
         cd_account = self.cd_accounts[cd_account_device.id]
         vehicle = cd_account.get_vehicle(vin)
+        if not vehicle and await self.ensure_account_vehicles(cd_account_device.id):
+            vehicle = cd_account.get_vehicle(vin)
         if not vehicle:
             self.logger.warning(f"{cd_account_device.name}: async_send_command_action: vehicle not found")
             return None
@@ -476,4 +1609,6 @@ class Plugin(indigo.PluginBase):
                 self.logger.warning(f"{vin}: send_command_action unknown serviceCode: {plugin_action.props['serviceCode']}")
                 return None
 
-        self.logger.debug(f"{vehicle.name}: send_command_action {plugin_action.props['serviceCode']} result: {status.state}")
+        self.logger.debug(f"{vehicle.name}: send_command_action {plugin_action.props['serviceCode']} result: {status.state.value}")
+        # the plain string, str() of bimmer_connected's ExecutionState is "ExecutionState.EXECUTED"
+        return status.state.value
@@ -0,0 +1,114 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import deque
+
+CHARGE_IDLE_TIMEOUT = 30.0 * 60.0   # seconds without a battery increase before a charge counts as complete
+RECENT_SESSIONS = 20                # completed trips and charges kept per vehicle
+
+
+class SessionDetector:
+    """
+    Works out trips and charging sessions from successive vehicle samples.  Each sample is compared
+    only with the one before it and the session in progress, so the cost per sample is constant.
+
+    A sample is a dict with ts, mileage, fuel, battery, lat, lon, charging and active.
+    A trip runs while the vehicle is active or its mileage goes up, and ends at the first sample
+    where it is no longer active.  A charge runs while the charger is connected and the battery level
+    goes up, and ends when the charger is disconnected, the battery is full, or the level stops rising.
+    """
+
+    def __init__(self):
+        self.last = {}          # VIN -> previous sample
+        self.trip = {}          # VIN -> trip in progress
+        self.charge = {}        # VIN -> charge in progress
+        self.trips = {}         # VIN -> deque of completed trips
+        self.charges = {}       # VIN -> deque of completed charges
+
+    def process(self, vin, sample):
+        """
+        Feed one sample.  Returns a list of ("trip" | "charge", session) for sessions it completed.
+        """
+        last = self.last.get(vin)
+        if last and last['ts'] == sample['ts']:
+            return []
+        self.last[vin] = sample
+        completed = []
+
+        moved = last is not None and _increased(last['mileage'], sample['mileage'])
+        trip = self.trip.get(vin)
+        if trip is None and (sample['active'] or moved):
+            trip = self.trip[vin] = _start_trip(last or sample)
+        if trip and not sample['active']:
+            completed.append(("trip", self._finish_trip(vin, sample)))
+
+        rising = last is not None and _increased(last['battery'], sample['battery'])
+        charge = self.charge.get(vin)
+        if charge is None and sample['charging'] and rising:
+            charge = self.charge[vin] = {'start': last['ts'], 'battery_start': last['battery'], 'last_rise': last['ts']}
+        if charge:
+            if rising:
+                charge['last_rise'] = sample['ts']
+            if not sample['charging'] or (sample['battery'] or 0) >= 100 or sample['ts'] - charge['last_rise'] > CHARGE_IDLE_TIMEOUT:
+                completed.append(("charge", self._finish_charge(vin, sample)))
+
+        return completed
+
+    def _finish_trip(self, vin, sample):
+        trip = self.trip.pop(vin)
+        distance = _difference(sample['mileage'], trip['mileage_start'])
+        duration = sample['ts'] - trip['start']
+        trip.update({
+            'end': sample['ts'],
+            'duration': duration,
+            'mileage_end': sample['mileage'],
+            'distance': distance,
+            'fuel_used': _difference(trip['fuel_start'], sample['fuel']),
+            'battery_used': _difference(trip['battery_start'], sample['battery']),
+            'average_speed': round(distance / (duration / 3600.0), 1) if distance and duration > 0 else None,
+            'end_position': (sample['lat'], sample['lon']),
+        })
+        self.trips.setdefault(vin, deque(maxlen=RECENT_SESSIONS)).append(trip)
+        return trip
+
+    def _finish_charge(self, vin, sample):
+        charge = self.charge.pop(vin)
+        duration = charge['last_rise'] - charge['start']
+        added = _difference(sample['battery'], charge['battery_start'])
+        charge.update({
+            'end': charge['last_rise'],
+            'duration': duration,
+            'battery_end': sample['battery'],
+            'battery_added': added,
+            'rate_per_hour': round(added / (duration / 3600.0), 1) if added and duration > 0 else None,
+        })
+        self.charges.setdefault(vin, deque(maxlen=RECENT_SESSIONS)).append(charge)
+        return charge
+
+    def last_trip(self, vin):
+        trips = self.trips.get(vin)
+        return trips[-1] if trips else None
+
+    def last_charge(self, vin):
+        charges = self.charges.get(vin)
+        return charges[-1] if charges else None
+
+    def recent(self, vin):
+        return {'trips': list(self.trips.get(vin, ())), 'charges': list(self.charges.get(vin, ())),
+                'trip_in_progress': self.trip.get(vin), 'charge_in_progress': self.charge.get(vin)}
+
+
+def _start_trip(sample):
+    return {'start': sample['ts'], 'mileage_start': sample['mileage'], 'fuel_start': sample['fuel'],
+            'battery_start': sample['battery'], 'start_position': (sample['lat'], sample['lon'])}
+
+
+def _increased(before, after):
+    return before is not None and after is not None and after > before
+
+
+def _difference(a, b):
+    # only meaningful if a is at least b, refueling during a trip makes fuel used meaningless
+    if a is None or b is None or a < b:
+        return None
+    return a - b
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+ALL_VEHICLES = "*"
+
+
+def select_fields(data, fields):
+    """
+    Pick fields out of a vehicle's JSON data.  Fields are dotted paths, like "fuel_and_battery.remaining_range_total".
+    With no fields, every leaf value is returned under its dotted path.  Paths that aren't there come back as None.
+    """
+    if not fields:
+        return flatten(data)
+    selected = {}
+    for field in fields:
+        value = data
+        for key in field.split("."):
+            value = value.get(key) if isinstance(value, dict) else None
+        selected[field] = value
+    return selected
+
+
+def flatten(data, prefix=""):
+    # lists are kept as single values, so a changed list is sent whole
+    leaves = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            leaves.update(flatten(value, f"{prefix}{key}."))
+        else:
+            leaves[f"{prefix}{key}"] = value
+    return leaves
+
+
+class Subscription:
+
+    def __init__(self, subscriber, vins, fields):
+        self.subscriber = subscriber
+        self.vins = set(vins) or {ALL_VEHICLES}
+        self.fields = list(fields)
+        self.sent = {}          # VIN -> {field: value} last pushed to this subscriber
+
+    def wants(self, vin):
+        return ALL_VEHICLES in self.vins or vin in self.vins
+
+    def changes(self, vin, data):
+        # only the fields whose value differs from what this subscriber was last sent
+        current = select_fields(data, self.fields)
+        sent = self.sent.get(vin, {})
+        changed = {field: value for field, value in current.items() if field not in sent or sent[field] != value}
+        self.sent[vin] = current
+        return changed
+
+    def as_dict(self):
+        return {'subscriber': self.subscriber, 'vins': sorted(self.vins), 'fields': self.fields}
+
+
+class SubscriptionRegistry:
+    """
+    Consumers that want vehicle data pushed to them instead of polling for it.  Each subscriber
+    names the VINs and fields it wants, and after every poll gets only the fields that changed.
+    Subscribe and unsubscribe come from Indigo action threads, publishing from the event loop, hence the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}     # subscriber -> Subscription
+
+    def subscribe(self, subscriber, vins=(), fields=(), current=None):
+        """
+        Subscribing again replaces the earlier subscription.  current is {VIN: data} for the vehicles on hand,
+        the selected fields of the ones this subscriber wants are returned, and only changes are pushed after that.
+        """
+        subscription = Subscription(subscriber, vins, fields)
+        initial = {vin: subscription.changes(vin, data) for vin, data in (current or {}).items() if subscription.wants(vin)}
+        with self.lock:
+            self.subscriptions[subscriber] = subscription
+        return initial
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            return self.subscriptions.pop(subscriber, None) is not None
+
+    def any_for(self, vin):
+        with self.lock:
+            return any(subscription.wants(vin) for subscription in self.subscriptions.values())
+
+    def changes(self, vin, data):
+        """
+        Returns [(subscriber, {field: value})] for every subscriber to this VIN that has something new.
+        """
+        with self.lock:
+            updates = [(subscription.subscriber, subscription.changes(vin, data))
+                       for subscription in self.subscriptions.values() if subscription.wants(vin)]
+        return [(subscriber, changed) for subscriber, changed in updates if changed]
+
+    def as_list(self):
+        with self.lock:
+            return [subscription.as_dict() for subscription in self.subscriptions.values()]
+
+    def load(self, saved):
+        for entry in saved:
+            self.subscribe(entry['subscriber'], entry.get('vins', ()), entry.get('fields', ()))
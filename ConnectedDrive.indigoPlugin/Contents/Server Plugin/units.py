@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Unit conversion for device states.  The API reports metric values, so each unit system is just
+# a set of precomputed factors and formatters.  pint is only used to verify the factors, and is
+# only imported when that check is actually run.  There is no kWh formatter: the API reports an EV's
+# battery as a percentage and an electric range, never as energy.
+
+KM_PER_MILE = 1.609344
+LITERS_PER_GALLON = 3.785411784
+
+
+class MetricUnits:
+    name = "metric"
+    distance_factor = 1.0
+    volume_factor = 1.0
+
+    # the API has no fuel reading for an electric car, and no range for one that hasn't reported it;
+    # a missing reading is None with a blank uiValue
+
+    @staticmethod
+    def mileage(km, unit="km"):
+        if km is None:
+            return None, ""
+        return km, f"{km} {unit}"
+
+    @staticmethod
+    def fuel(liters):
+        if liters is None:
+            return None, ""
+        return liters, f"{liters} L"
+
+    @staticmethod
+    def range(km):
+        if km is None:
+            return None, ""
+        return km, f"{km} km"
+
+    @staticmethod
+    def distance(km):
+        return km, f"{km} km"
+
+    @staticmethod
+    def speed(kmh):
+        return kmh, f"{kmh:.1f} km/h"
+
+    @staticmethod
+    def percent(value):
+        return value, f"{value} %" if value else ""
+
+
+class USUnits(MetricUnits):
+    name = "us"
+    distance_factor = 1.0 / KM_PER_MILE
+    volume_factor = 1.0 / LITERS_PER_GALLON
+
+    @classmethod
+    def mileage(cls, km, unit="km"):
+        if km is None:
+            return None, ""
+        miles = int(km * cls.distance_factor)
+        return miles, f"{miles} mi"
+
+    @classmethod
+    def fuel(cls, liters):
+        if liters is None:
+            return None, ""
+        gallons = float(liters * cls.volume_factor)
+        return gallons, f"{gallons:.1f} gal"
+
+    @classmethod
+    def range(cls, km):
+        if km is None:
+            return None, ""
+        miles = int(km * cls.distance_factor)
+        return miles, f"{miles} mi"
+
+    @classmethod
+    def distance(cls, km):
+        miles = float(km * cls.distance_factor)
+        return miles, f"{miles:.2f} mi"
+
+    @classmethod
+    def speed(cls, kmh):
+        mph = round(kmh * cls.distance_factor, 1)
+        return mph, f"{mph:.1f} mph"
+
+
+UNIT_SYSTEMS = {
+    MetricUnits.name: MetricUnits,
+    USUnits.name: USUnits,
+}
+
+
+def get_units(name):
+    return UNIT_SYSTEMS.get(name, USUnits)
+
+
+def verify_with_pint(tolerance=1e-9):
+    """
+    Compare the precomputed factors against pint.
+    Returns a list of (name, ours, pint's) for every factor that doesn't match.
+    """
+    from pint import UnitRegistry
+    ureg = UnitRegistry()
+
+    checks = [
+        ("km -> mi", USUnits.distance_factor, (1.0 * ureg.kilometer).to(ureg.mile).magnitude),
+        ("L -> gal", USUnits.volume_factor, (1.0 * ureg.liter).to(ureg.gallon).magnitude),
+    ]
+    return [(name, ours, theirs) for name, ours, theirs in checks if abs(ours - theirs) > tolerance * abs(theirs)]
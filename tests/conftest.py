@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "tools", "bench"))
+
+
+@pytest.fixture
+def bench(monkeypatch):
+    """The plugin, started against the stub MyBMW API with 2 accounts of 2 vehicles each, after its first poll."""
+    harness = pytest.importorskip("harness")
+    # nothing to wait for against the stub
+    monkeypatch.setattr(harness.plugin, "ACCOUNT_STAGGER", 0.0)
+    monkeypatch.setattr(harness.plugin, "COMMAND_COALESCE_DELAY", 0.0)
+    monkeypatch.setattr(harness.plugin, "FLEET_COMMAND_SPACING", 0.0)
+    monkeypatch.setattr(harness.remote_services, "_POLLING_CYCLE", 0.0)
+    args = harness.build_parser().parse_args(["--accounts", "2", "--vehicles", "2", "--latency", "0", "--seed", "1"])
+    bench = harness.Bench(args)
+    with bench.stub:
+        bench.cold_start()
+        try:
+            yield bench
+        finally:
+            bench.stop_plugin()
+            bench.close()
@@ -0,0 +1,43 @@
+import time
+
+import httpx
+
+import indigo
+
+
+def add_auth_error_trigger():
+    indigo.triggers[1] = indigo.Trigger(1, "auth_error")
+    indigo.counters.reset()
+
+
+def test_rejected_refresh_token_is_an_auth_incident(bench):
+    add_auth_error_trigger()
+    # with every token forgotten, the 401 login falls back to a password login, which wants a captcha
+    bench.stub.access_tokens.clear()
+    bench.stub.refresh_tokens.clear()
+
+    assert bench.on_loop(bench.poll_cycle()) == [False, False]
+    assert all(state['incident'] for state in bench.plugin.token_state.values())
+    assert indigo.counters.triggers_executed == 2
+
+    # once per incident, not once per poll
+    bench.on_loop(bench.poll_cycle())
+    assert indigo.counters.triggers_executed == 2
+
+
+def test_network_error_during_token_refresh_only_backs_off(bench, monkeypatch):
+    add_auth_error_trigger()
+    dev_id = next(iter(bench.account_vins))
+    account = bench.plugin.cd_accounts[dev_id]
+
+    async def login():
+        raise httpx.ConnectError("network is unreachable")
+
+    monkeypatch.setattr(account.config.authentication, "login", login)
+    bench.on_loop(bench.plugin.refresh_account_token(dev_id, account, account.config.authentication.expires_at))
+
+    state = bench.plugin.token_state[dev_id]
+    assert state['failures'] == 1
+    assert state['retry_at'] > time.time()
+    assert not state['incident']
+    assert indigo.counters.triggers_executed == 0
@@ -0,0 +1,31 @@
+import time
+
+import pytest
+
+import indigo
+
+
+def test_unchanged_poll_writes_no_states(bench, monkeypatch):
+    # parked vehicles back off poll by poll, hold the interval still so only the data age could change
+    monkeypatch.setattr(bench.plugin, "compute_poll_interval", lambda vehicle: (60 * 60.0, "parked"))
+    bench.on_loop(bench.poll_cycle())
+    indigo.counters.reset()
+
+    bench.on_loop(bench.poll_cycle())
+    assert indigo.counters.states_written == 0
+
+
+def test_data_age_timer_waits_for_the_next_bucket(bench):
+    plugin = bench.plugin
+    vin = sorted(plugin.vehicle_data)[0]
+    device = indigo.devices[int(plugin.cd_vehicles[vin])]
+
+    async def reported(minutes_ago):
+        plugin.vehicle_poll[vin] = {'interval': 4 * 60 * 60.0}
+        plugin.vehicle_data[vin].reported = time.time() - minutes_ago * 60.0
+        plugin.refresh_data_age(vin)
+        return plugin.data_age_due - plugin.vehicle_data[vin].reported
+
+    assert bench.on_loop(reported(20)) == pytest.approx(30 * 60.0)
+    assert device.states['data_age'] == 15
+    assert device.states['stale'] is False
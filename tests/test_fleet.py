@@ -0,0 +1,11 @@
+import indigo
+
+
+def test_fleet_command_counts_executed(bench):
+    bench.args.fleet = "lock"
+    summary = bench.fleet()
+
+    assert summary['executed'] == 4
+    assert {result['state'] for result in summary['vehicles'].values()} == {"EXECUTED"}
+    assert {device.states['last_command_state'] for device in indigo.devices.values()
+            if device.deviceTypeId == "cdVehicle"} == {"EXECUTED"}
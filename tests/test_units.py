@@ -0,0 +1,87 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ConnectedDrive.indigoPlugin", "Contents", "Server Plugin"))
+
+from units import MetricUnits, USUnits, get_units, verify_with_pint  # noqa: E402
+
+pint = pytest.importorskip("pint")
+ureg = pint.UnitRegistry()
+
+KILOMETERS = [0, 1, 7, 42, 99, 160, 161, 999, 12345, 54321, 123456, 299999]
+LITERS = [0, 0.5, 1, 3.785, 7, 12.5, 33, 45.2, 60, 78]
+DISTANCES = [0.0, 0.01, 0.5, 1.0, 1.609344, 2.5, 10.25, 33.3, 150.0, 1234.56]
+
+
+# the US state values and uiValues the plugin used to compute with pint on every poll
+
+def pint_mileage(km):
+    mileage = (km * ureg.kilometer).to(ureg.miles)
+    return int(mileage.magnitude), f"{int(mileage.magnitude)} mi"
+
+
+def pint_fuel(liters):
+    fuel = (liters * ureg.liter).to(ureg.gallon)
+    return float(fuel.magnitude), f"{fuel.magnitude:.1f} gal"
+
+
+def pint_range(km):
+    range = (km * ureg.kilometer).to(ureg.miles)
+    return int(range.magnitude), f"{int(range.magnitude)} mi"
+
+
+def pint_distance(km):
+    distance = (km * ureg.kilometer).to(ureg.miles)
+    return float(distance.magnitude), f"{distance.magnitude:.2f} mi"
+
+
+def test_factors_match_pint():
+    assert verify_with_pint() == []
+
+
+@pytest.mark.parametrize("km", KILOMETERS)
+def test_us_mileage(km):
+    assert USUnits.mileage(km, "km") == pint_mileage(km)
+
+
+@pytest.mark.parametrize("liters", LITERS)
+def test_us_fuel(liters):
+    value, ui_value = USUnits.fuel(liters)
+    expected_value, expected_ui_value = pint_fuel(liters)
+    assert value == pytest.approx(expected_value, rel=1e-12)
+    assert ui_value == expected_ui_value
+
+
+@pytest.mark.parametrize("km", KILOMETERS)
+def test_us_range(km):
+    assert USUnits.range(km) == pint_range(km)
+
+
+@pytest.mark.parametrize("km", DISTANCES)
+def test_us_distance(km):
+    value, ui_value = USUnits.distance(km)
+    expected_value, expected_ui_value = pint_distance(km)
+    assert value == pytest.approx(expected_value, rel=1e-12)
+    assert ui_value == expected_ui_value
+
+
+def test_metric_passes_values_through():
+    assert MetricUnits.mileage(12345, "km") == (12345, "12345 km")
+    assert MetricUnits.fuel(45.2) == (45.2, "45.2 L")
+    assert MetricUnits.range(321) == (321, "321 km")
+    assert MetricUnits.distance(1.5) == (1.5, "1.5 km")
+
+
+def test_unknown_units_default_to_us():
+    assert get_units("metric") is MetricUnits
+    assert get_units("imperial") is USUnits
+
+
+@pytest.mark.parametrize("units", [MetricUnits, USUnits])
+def test_missing_readings_are_blank(units):
+    # an electric car has no fuel reading, the old pint code raised TypeError on it
+    assert units.mileage(None, "km") == (None, "")
+    assert units.fuel(None) == (None, "")
+    assert units.range(None) == (None, "")
@@ -0,0 +1,38 @@
+import asyncio
+import json
+
+import indigo
+
+
+def test_account_polls_share_one_cache_write(bench, monkeypatch):
+    plugin = bench.plugin
+    monkeypatch.setattr("plugin.VEHICLE_CACHE_SAVE_DELAY", 0.05)
+    saves = []
+    monkeypatch.setattr(plugin, "save_vehicle_cache", lambda: saves.append(True))
+
+    async def cycle():
+        # the first poll's write may still be waiting
+        if plugin.cache_save_handle:
+            plugin.cache_save_handle.cancel()
+            plugin.cache_save_handle = None
+        await bench.poll_cycle()
+        await asyncio.sleep(0.2)
+
+    bench.on_loop(cycle())
+    assert len(saves) == 1
+
+
+def test_deleted_account_leaves_the_cache(bench):
+    plugin = bench.plugin
+    dev_id, vins = next(iter(bench.account_vins.items()))
+    plugin.device_deleted(indigo.devices.pop(dev_id))
+
+    async def save():
+        plugin.save_vehicle_cache()
+
+    bench.on_loop(save())
+    assert not set(vins) & {vin for vin, _ in plugin.get_vehicle_list()}
+    with open(plugin.vehicle_cache_path) as f:
+        cached = json.load(f)['vehicles']
+    assert cached
+    assert not set(vins) & set(cached)
@@ -0,0 +1,24 @@
+import indigo
+
+
+def test_zone_devices_change_zones_on_the_event_loop(bench):
+    plugin = bench.plugin
+    zone = indigo.Device(5000, "Office", "cdZone", pluginProps={'latitude': "40.0", 'longitude': "-105.0", 'radius': "100"})
+    indigo.devices[zone.id] = zone
+
+    async def zones():
+        # queued callbacks run before this does
+        return dict(plugin.cd_zones), set(plugin.geofence.zones)
+
+    plugin.device_start_comm(zone)
+    cd_zones, geofence_zones = bench.on_loop(zones())
+    assert cd_zones == {"5000": 5000}
+    assert "5000" in geofence_zones
+
+    bench.on_loop(bench.poll_cycle())
+    assert zone.states['vehicle_count'] == 0
+
+    plugin.device_stop_comm(zone)
+    cd_zones, geofence_zones = bench.on_loop(zones())
+    assert cd_zones == {}
+    assert "5000" not in geofence_zones
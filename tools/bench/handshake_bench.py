@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Count TLS handshakes and time requests the way bimmer_connected makes them, against a local HTTPS server.
+
+bimmer_connected 0.17 opens a new httpx client for every API call (each vehicle list, vehicle fetch and remote
+service), so every call is a new connection and a full handshake.  The plugin hands every account one shared
+SSL context, which saves loading the CA bundle per client, but cannot save a handshake.  This compares:
+
+    context per client   what bimmer_connected does by default, a new SSL context with the CA bundle per client
+    shared context       what the plugin does, one SSL context for every client
+    shared client        one client for every request, for reference, bimmer_connected has no way to do this
+
+    python tools/bench/handshake_bench.py --requests 200
+
+The server's certificate is made with the openssl command line tool.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import time
+
+import certifi
+import httpx
+
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 2\r\n\r\n{}"
+
+
+class HandshakeServer:
+    """HTTPS server answering every request with {}, counting connections and how many resumed a TLS session."""
+
+    def __init__(self, certfile, keyfile):
+        self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.context.load_cert_chain(certfile, keyfile)
+        self.server = None
+        self.port = None
+        self.handshakes = 0
+        self.resumed = 0
+        self.requests = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0, ssl=self.context)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def reset(self):
+        self.handshakes = self.resumed = self.requests = 0
+
+    async def handle(self, reader, writer):
+        self.handshakes += 1
+        if writer.get_extra_info("ssl_object").session_reused:
+            self.resumed += 1
+        try:
+            while await reader.readuntil(b"\r\n\r\n"):
+                self.requests += 1
+                writer.write(RESPONSE)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def make_certificate(folder):
+    certfile, keyfile = os.path.join(folder, "cert.pem"), os.path.join(folder, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+                    "-addext", "subjectAltName=IP:127.0.0.1", "-keyout", keyfile, "-out", certfile],
+                   check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def client_context(certfile):
+    # the CA bundle httpx loads for verify=True, plus the local server's certificate
+    context = ssl.create_default_context(cafile=certifi.where())
+    context.load_verify_locations(certfile)
+    return context
+
+
+async def context_per_client(url, count, certfile):
+    for _ in range(count):
+        async with httpx.AsyncClient(verify=client_context(certfile)) as client:
+            (await client.get(url)).raise_for_status()
+
+
+async def shared_context(url, count, certfile):
+    context = client_context(certfile)
+    for _ in range(count):
+        async with httpx.AsyncClient(verify=context) as client:
+            (await client.get(url)).raise_for_status()
+
+
+async def shared_client(url, count, certfile):
+    async with httpx.AsyncClient(verify=client_context(certfile)) as client:
+        for _ in range(count):
+            (await client.get(url)).raise_for_status()
+
+
+async def run(args, certfile, keyfile):
+    server = HandshakeServer(certfile, keyfile)
+    await server.start()
+    url = f"https://127.0.0.1:{server.port}/"
+    results = {}
+    try:
+        for name, requests in (("context per client", context_per_client), ("shared context", shared_context),
+                               ("shared client", shared_client)):
+            await requests(url, 5, certfile)     # warm up imports and the server
+            server.reset()
+            cpu, started = time.process_time(), time.perf_counter()
+            await requests(url, args.requests, certfile)
+            wall, cpu = time.perf_counter() - started, time.process_time() - cpu
+            results[name] = {'requests': server.requests, 'handshakes': server.handshakes, 'resumed': server.resumed,
+                             'wall_ms_per_request': round(wall / args.requests * 1000.0, 3),
+                             'cpu_ms_per_request': round(cpu / args.requests * 1000.0, 3)}
+    finally:
+        await server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count TLS handshakes for per call httpx clients, with and without a shared SSL context.")
+    parser.add_argument("--requests", type=int, default=200, help="requests for each approach")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    if not shutil.which("openssl"):
+        parser.error("the openssl command line tool is needed to make the server's certificate")
+    with tempfile.TemporaryDirectory(prefix="handshake-bench-") as folder:
+        results = asyncio.run(run(args, *make_certificate(folder)))
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+    print(f"{args.requests} sequential GETs over TLS to 127.0.0.1, client and server CPU both counted")
+    columns = [('requests', "requests"), ('handshakes', "handshakes"), ('resumed', "resumed"),
+               ('wall_ms_per_request', "wall ms/req"), ('cpu_ms_per_request', "cpu ms/req")]
+    print(f"{'':>20}" + "".join(f"{title:>13}" for _, title in columns))
+    for name, result in results.items():
+        print(f"{name:>20}" + "".join(f"{result[key]:>13}" for key, _ in columns))
+
+
+if __name__ == "__main__":
+    main()
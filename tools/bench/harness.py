@@ -0,0 +1,339 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Run the plugin against the stub MyBMW API for N accounts with M vehicles each, and report what a
+poll cycle costs: wall time, CPU per vehicle, Indigo state writes and peak memory.  It also times a
+cold start, remote commands, and a warm restart from the vehicle cache followed by a command.
+
+    python tools/bench/harness.py --accounts 10 --vehicles 5 --latency 0.1 --cycles 5
+
+Vehicles are replayed from tools/bench/fixtures, or from --fixtures, a folder written by the plugin's
+Record Vehicle Fixtures menu item.  Everything runs in this process, so the stub's own CPU time is
+measured separately and left out of the per vehicle figure.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_FOLDER = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_FOLDER = os.path.join(BENCH_FOLDER, "..", "..", "ConnectedDrive.indigoPlugin", "Contents", "Server Plugin")
+sys.path.insert(0, os.path.abspath(PLUGIN_FOLDER))
+sys.path.insert(0, BENCH_FOLDER)     # ahead of the plugin, so "import indigo" finds the stand-in
+
+import indigo  # noqa: E402
+import plugin  # noqa: E402
+import stub_api  # noqa: E402
+from bimmer_connected.vehicle import remote_services  # noqa: E402
+
+PLUGIN_ID = "com.flyingdiver.indigoplugin.bmw-cd"
+ACCOUNT_DEVICE_BASE = 1000
+VEHICLE_DEVICE_BASE = 100000
+LOOP_TIMEOUT = 600.0
+
+
+class PluginAction:
+
+    def __init__(self, props):
+        self.props = indigo.Dict(props)
+
+
+class Bench:
+
+    def __init__(self, args):
+        self.args = args
+        self.stub = stub_api.StubMyBMW(stub_api.load_fixtures(args.fixtures), latency=args.latency, jitter=args.jitter,
+                                       error_rate=args.error_rate, quota_rate=args.quota_rate,
+                                       token_lifetime=args.token_lifetime, seed=args.seed)
+        self.prefs = indigo.Dict({'logLevel': "10" if args.verbose else "30", 'updateFrequency': "15", 'units': "us",
+                                  'maxConcurrentAccounts': str(args.max_concurrent), 'accountTimeout': "120"})
+        self.account_vins = {}      # account device id -> [VIN]
+        for account in range(args.accounts):
+            dev_id = ACCOUNT_DEVICE_BASE + account
+            tokens = self.stub.add_account(account, args.vehicles)
+            self.prefs[plugin.AUTH_TOKEN_PLUGIN_PREF.format(dev_id)] = json.dumps(tokens)
+            self.account_vins[dev_id] = self.stub.accounts[account]
+        self.vehicle_count = args.accounts * args.vehicles
+        self.plugin = None
+        # the plugin's vehicle cache and history go here, and leave with it.  The warm start reads the cache the first run saved.
+        self.folder = tempfile.TemporaryDirectory(prefix="indigo-bench-", ignore_cleanup_errors=True)
+        indigo.server.install_folder = self.folder.name
+        self.report = {'config': {key: value for key, value in vars(args).items() if key not in ("json", "verbose")}}
+
+    ########################################
+    # Plugin lifecycle
+    ########################################
+
+    def start_plugin(self):
+        """Create the plugin and start every device, the way Indigo does.  Returns the seconds it took."""
+        indigo.reset()
+        started = time.perf_counter()
+        self.plugin = plugin.Plugin(PLUGIN_ID, "Connected Drive", "bench", self.prefs)
+        if self.args.verbose:
+            self.plugin.logger.setLevel(indigo.THREADDEBUG)
+        self.plugin.startup()
+
+        devices = []
+        for index, (dev_id, vins) in enumerate(self.account_vins.items()):
+            devices.append(indigo.Device(dev_id, f"Account {index}", "cdAccount",
+                                         pluginProps={'username': f"user{index}", 'password': "bench", 'region': "north_america"}))
+        for dev_id, vin in enumerate((vin for vins in self.account_vins.values() for vin in vins), VEHICLE_DEVICE_BASE):
+            devices.append(indigo.Device(dev_id, vin, "cdVehicle", address=vin, pluginProps={'state_key': "mileage"}))
+        for device in devices:
+            indigo.devices[device.id] = device
+            self.plugin.device_start_comm(device)
+        return time.perf_counter() - started
+
+    def stop_plugin(self):
+        self.plugin.stop_concurrent_thread()
+        self.plugin.shutdown()
+        deadline = time.time() + LOOP_TIMEOUT
+        while not self.plugin.event_loop.is_closed():
+            if time.time() > deadline:
+                raise TimeoutError("plugin event loop did not stop")
+            time.sleep(0.01)
+
+    def close(self):
+        self.folder.cleanup()
+
+    def on_loop(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.plugin.event_loop).result(timeout=LOOP_TIMEOUT)
+
+    async def unschedule_accounts(self):
+        # the harness drives the polls, so the plugin's own scheduler must not start any in between
+        for dev_id in self.account_vins:
+            self.plugin.unschedule_account(dev_id)
+
+    ########################################
+    # Phases
+    ########################################
+
+    def cold_start(self):
+        """
+        Start with no vehicle cache, so the scheduler polls every account right away.
+        Times startup itself, and how long until every vehicle has data.
+        """
+        # a failed first poll would wait out the plugin's retry backoff, so failures start with the timed cycles
+        error_rate, quota_rate = self.stub.error_rate, self.stub.quota_rate
+        self.stub.error_rate = self.stub.quota_rate = 0.0
+        startup = self.start_plugin()
+        started = time.perf_counter()
+        deadline = time.time() + LOOP_TIMEOUT
+        while len(self.plugin.vehicle_data) < self.vehicle_count or self.plugin.account_tasks:
+            if time.time() > deadline:
+                raise TimeoutError(f"only {len(self.plugin.vehicle_data)} of {self.vehicle_count} vehicles listed")
+            time.sleep(0.01)
+        first_poll = time.perf_counter() - started
+        self.stub.error_rate, self.stub.quota_rate = error_rate, quota_rate
+        self.on_loop(self.unschedule_accounts())
+        self.report['cold_start'] = {'startup': round(startup, 4), 'first_poll': round(first_poll, 3)}
+
+    async def poll_cycle(self):
+        async def account_update(dev_id):
+            # the same concurrency limit run_account_update applies
+            async with self.plugin.account_semaphore:
+                return await self.plugin.do_account_update(dev_id)
+
+        results = await asyncio.gather(*(account_update(dev_id) for dev_id in self.account_vins), return_exceptions=True)
+        await self.unschedule_accounts()
+        return results
+
+    def poll_cycles(self):
+        cycles = []
+        for cycle in range(self.args.cycles):
+            churned = self.stub.churn(self.args.churn)
+            indigo.counters.reset()
+            self.stub.reset_stats()
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            states_skipped = self.plugin.states_skipped
+            cpu = time.process_time()
+            started = time.perf_counter()
+
+            results = self.on_loop(self.poll_cycle())
+
+            wall = time.perf_counter() - started
+            cpu = time.process_time() - cpu - self.stub.cpu
+            counters = indigo.counters.as_dict()
+            requests = self.stub.stats()['requests']
+            cycles.append({
+                'cycle': cycle + 1,
+                'wall': round(wall, 4),
+                'cpu_per_vehicle_ms': round(cpu / self.vehicle_count * 1000.0, 3),
+                'vehicles_changed': churned,
+                'states_written': counters['states_written'],
+                'state_updates': counters['state_updates'],
+                'states_skipped': self.plugin.states_skipped - states_skipped,
+                'requests': sum(count for name, count in requests.items() if name not in ("unauthorized", "errors_injected",
+                                                                                         "quota_injected", "logins", "refresh_rejected")),
+                'unauthorized': requests.get('unauthorized', 0),
+                'logins': requests.get('logins', 0),
+                'refresh_rejected': requests.get('refresh_rejected', 0),
+                'errors_injected': requests.get('errors_injected', 0) + requests.get('quota_injected', 0),
+                'failed_accounts': sum(1 for result in results if result is not True),
+                'peak_traced_mib': round(tracemalloc.get_traced_memory()[1] / 2**20, 2) if tracemalloc.is_tracing() else None,
+            })
+        self.report['cycles'] = cycles
+
+    async def send_commands(self, vins, service):
+        async def send(vin):
+            account_dev = indigo.devices[int(self.plugin.vehicle_data[vin].account)]
+            started = time.perf_counter()
+            try:
+                state = await self.plugin.async_send_command_action(account_dev, vin, PluginAction({'serviceCode': service}))
+            except Exception as e:
+                state = f"ERROR {type(e).__name__}"
+            return vin, str(state), time.perf_counter() - started
+
+        return await asyncio.gather(*(send(vin) for vin in vins))
+
+    def commands(self):
+        vins = sorted(self.plugin.vehicle_data)[:self.args.command_vehicles or None]
+        results = []
+        for _ in range(self.args.commands):
+            results.extend(self.on_loop(self.send_commands(vins, self.args.command)))
+        latencies = sorted(latency for _, _, latency in results)
+        states = {}
+        for _, state, _ in results:
+            states[state] = states.get(state, 0) + 1
+        self.report['commands'] = {'service': self.args.command, 'sent': len(results), 'states': states,
+                                   **self.latency_summary(latencies)}
+
+    def fleet(self):
+        """Send a fleet command to every vehicle, as the Send Fleet Command action does.  Returns the plugin's summary."""
+        vins = self.plugin.select_fleet_vehicles({'target': "all"})
+        started = time.perf_counter()
+        summary = self.on_loop(self.plugin.run_fleet_command(PluginAction({'serviceCode': self.args.fleet, 'target': "all"}), vins))
+        states = {}
+        for result in summary['vehicles'].values():
+            states[result['state']] = states.get(result['state'], 0) + 1
+        self.report['fleet'] = {'service': self.args.fleet, 'vehicles': len(vins), 'executed': summary['executed'],
+                                'states': states, 'wall': round(time.perf_counter() - started, 3)}
+        return summary
+
+    def warm_start(self):
+        """
+        Restart from the vehicle cache the first run saved, then send one command.  The account has not
+        listed its vehicles yet, so the command pays for that.
+        """
+        startup = self.start_plugin()
+        vin = sorted(self.plugin.vehicle_data)[0]
+        [(_, state, latency)] = self.on_loop(self.send_commands([vin], self.args.command))
+        self.report['warm_start'] = {'startup': round(startup, 4), 'cached_vehicles': len(self.plugin.vehicle_data),
+                                     'first_command': round(latency, 3), 'first_command_state': state}
+
+    @staticmethod
+    def latency_summary(latencies):
+        if not latencies:
+            return {}
+        return {'p50': round(statistics.median(latencies), 3),
+                'p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+                'max': round(latencies[-1], 3)}
+
+    def run(self):
+        remote_services._POLLING_CYCLE = self.args.polling_cycle
+        # the scheduler spaces accounts out in production, the benchmark wants them all at once
+        plugin.ACCOUNT_STAGGER = 0.0
+        if self.args.trace_memory:
+            tracemalloc.start()
+        try:
+            with self.stub:
+                self.cold_start()
+                try:
+                    self.poll_cycles()
+                    if self.args.commands:
+                        self.commands()
+                    if self.args.fleet:
+                        self.fleet()
+                    self.report['plugin_metrics'] = self.plugin.metrics.snapshot()
+                finally:
+                    self.stop_plugin()
+                if self.args.commands:
+                    try:
+                        self.warm_start()
+                    finally:
+                        self.stop_plugin()
+        finally:
+            self.close()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.report['max_rss_mib'] = round(rss / (2**20 if sys.platform == "darwin" else 2**10), 1)
+        return self.report
+
+
+def print_report(report):
+    config = report['config']
+    print(f"{config['accounts']} accounts x {config['vehicles']} vehicles, latency {config['latency'] * 1000:.0f} ms "
+          f"+/-{config['jitter'] * 100:.0f}%, error rate {config['error_rate']:.0%}, quota rate {config['quota_rate']:.0%}, "
+          f"token lifetime {config['token_lifetime'] or 'unlimited'}")
+    print(f"cold start: startup {report['cold_start']['startup'] * 1000:.1f} ms, first poll {report['cold_start']['first_poll']:.2f} s")
+
+    cycles = report['cycles']
+    columns = [('cycle', "cycle", "{}"), ('wall', "wall s", "{:.3f}"), ('cpu_per_vehicle_ms', "cpu ms/veh", "{:.2f}"),
+               ('vehicles_changed', "changed", "{}"), ('states_written', "states", "{}"), ('state_updates', "updates", "{}"),
+               ('requests', "requests", "{}"), ('unauthorized', "401s", "{}"), ('logins', "logins", "{}"),
+               ('errors_injected', "errors", "{}"), ('failed_accounts', "failed", "{}")]
+    if cycles and cycles[0]['peak_traced_mib'] is not None:
+        columns.append(('peak_traced_mib', "peak MiB", "{:.2f}"))
+    print("  ".join(f"{title:>10}" for _, title, _ in columns))
+    for cycle in cycles:
+        print("  ".join(f"{fmt.format(cycle[key]):>10}" for key, _, fmt in columns))
+    if len(cycles) > 1:
+        means = {key: statistics.mean(cycle[key] for cycle in cycles) for key, _, _ in columns[1:]}
+        print("  ".join([f"{'mean':>10}"] + [f"{means[key]:>10.2f}" for key, _, _ in columns[1:]]))
+
+    if commands := report.get('commands'):
+        print(f"commands: {commands['sent']} {commands['service']} sent, {commands['states']}, "
+              f"latency p50 {commands.get('p50', 0):.3f} s, p95 {commands.get('p95', 0):.3f} s, max {commands.get('max', 0):.3f} s")
+    if fleet := report.get('fleet'):
+        print(f"fleet: {fleet['service']} {fleet['executed']} of {fleet['vehicles']} executed in {fleet['wall']:.3f} s, {fleet['states']}")
+    if warm := report.get('warm_start'):
+        print(f"warm start: startup {warm['startup'] * 1000:.1f} ms with {warm['cached_vehicles']} cached vehicles, "
+              f"first command {warm['first_command']:.3f} s ({warm['first_command_state']})")
+    print(f"max RSS: {report['max_rss_mib']} MiB")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the Connected Drive plugin against a stub MyBMW API.")
+    parser.add_argument("--accounts", type=int, default=3, help="number of accounts")
+    parser.add_argument("--vehicles", type=int, default=4, help="vehicles per account")
+    parser.add_argument("--cycles", type=int, default=5, help="poll cycles to time after the first poll")
+    parser.add_argument("--churn", type=float, default=0.25, help="fraction of vehicles reporting new data each cycle")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the stub takes to answer each request")
+    parser.add_argument("--jitter", type=float, default=0.5, help="+/- fraction of the latency, randomized per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of API requests answered with a 500")
+    parser.add_argument("--quota-rate", type=float, default=0.0, help="fraction of API requests answered with a 429")
+    parser.add_argument("--token-lifetime", type=float, default=0.0, help="seconds before an access token gets a 401, 0 for never")
+    parser.add_argument("--max-concurrent", type=int, default=4, help="the plugin's maxConcurrentAccounts pref")
+    parser.add_argument("--commands", type=int, default=1, help="rounds of remote commands, one per vehicle each round")
+    parser.add_argument("--command", default="light", help="serviceCode for the remote commands")
+    parser.add_argument("--command-vehicles", type=int, default=0, help="send commands to only this many vehicles, 0 for all")
+    parser.add_argument("--fleet", default="", help="serviceCode to send to every vehicle as a fleet command, none if empty")
+    parser.add_argument("--polling-cycle", type=float, default=0.1, help="seconds between remote service status polls")
+    parser.add_argument("--fixtures", default=stub_api.FIXTURES_FOLDER, help="folder of recorded vehicle fixtures")
+    parser.add_argument("--trace-memory", action="store_true", help="report peak Python heap per cycle (slows everything down)")
+    parser.add_argument("--seed", type=int, default=None, help="seed for latency, failures and churn")
+    parser.add_argument("--json", action="store_true", help="print the full report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the plugin's debug logging")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+
+    report = Bench(args).run()
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# A stand-in for the parts of Indigo's plugin API that plugin.py uses, so the plugin can run outside
+# Indigo for benchmarks.  State pushes, trigger executions and prefs saves are counted, not stored
+# anywhere else.
+
+import logging
+import threading
+
+THREADDEBUG = 5
+logging.addLevelName(THREADDEBUG, "THREADDEBUG")
+
+
+class PluginLogger(logging.Logger):
+
+    def threaddebug(self, msg, *args, **kwargs):
+        if self.isEnabledFor(THREADDEBUG):
+            self._log(THREADDEBUG, msg, args, **kwargs)
+
+
+class Dict(dict):
+    pass
+
+
+class List(list):
+    pass
+
+
+class Counters:
+    """
+    What the plugin asked Indigo to do.  Devices push states from the plugin's event loop thread
+    while the harness reads the totals, hence the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.state_updates = 0      # updateStatesOnServer calls
+            self.states_written = 0     # states sent in those calls
+            self.triggers_executed = 0
+            self.broadcasts = 0
+            self.prefs_saves = 0
+
+    def add(self, name, count=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + count)
+
+    def as_dict(self):
+        with self.lock:
+            return {'state_updates': self.state_updates, 'states_written': self.states_written,
+                    'triggers_executed': self.triggers_executed, 'broadcasts': self.broadcasts,
+                    'prefs_saves': self.prefs_saves}
+
+
+counters = Counters()
+
+
+class Device:
+
+    def __init__(self, dev_id, name, deviceTypeId, address="", pluginProps=None):
+        self.id = dev_id
+        self.name = name
+        self.deviceTypeId = deviceTypeId
+        self.address = address
+        self.pluginProps = Dict(pluginProps or {})
+        self.states = Dict()
+        self.enabled = True
+
+    def updateStatesOnServer(self, states_list):
+        for state in states_list:
+            self.states[state['key']] = state['value']
+        counters.add('state_updates')
+        counters.add('states_written', len(states_list))
+
+    def updateStateOnServer(self, key, value, uiValue=None):
+        self.updateStatesOnServer([{'key': key, 'value': value, 'uiValue': uiValue}])
+
+    def stateListOrDisplayStateIdChanged(self):
+        pass
+
+    def replacePluginPropsOnServer(self, props):
+        self.pluginProps = Dict(props)
+
+
+class DeviceList(dict):
+    # Indigo looks devices up by id, the plugin always passes ints
+
+    def iter(self, filter=""):
+        return iter(list(self.values()))
+
+
+class Trigger:
+
+    def __init__(self, trigger_id, pluginTypeId, pluginProps=None):
+        self.id = trigger_id
+        self.pluginTypeId = pluginTypeId
+        self.pluginProps = Dict(pluginProps or {})
+
+
+class TriggerList(dict):
+
+    def iter(self, filter=""):
+        return iter(list(self.values()))
+
+
+class _Trigger:
+
+    @staticmethod
+    def execute(trigger):
+        counters.add('triggers_executed')
+
+
+class _Server:
+
+    def __init__(self):
+        self.install_folder = None      # set by whoever runs the plugin, and removed by them afterwards
+        self.latitude = 40.0
+        self.longitude = -105.0
+
+    def getInstallFolderPath(self):
+        if not self.install_folder:
+            raise RuntimeError("indigo.server.install_folder has not been set")
+        return self.install_folder
+
+    def getLatitudeAndLongitude(self):
+        return self.latitude, self.longitude
+
+    def broadcastToSubscribers(self, messageType, message):
+        counters.add('broadcasts')
+
+    def log(self, message, type=None, isError=False, level=logging.INFO):
+        logging.getLogger("Indigo").log(logging.ERROR if isError else level, message)
+
+
+class kUniversalAction:
+    RequestStatus = "RequestStatus"
+    EnergyUpdate = "EnergyUpdate"
+    EnergyReset = "EnergyReset"
+
+
+class PluginBase:
+
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        self.pluginId = pluginId
+        self.pluginDisplayName = pluginDisplayName
+        self.pluginVersion = pluginVersion
+        self.pluginPrefs = pluginPrefs
+        self.stopThread = False
+
+        logging.setLoggerClass(PluginLogger)
+        self.logger = logging.getLogger("Plugin")
+        logging.setLoggerClass(logging.Logger)
+        self.logger.handlers.clear()    # a restarted plugin gets the same logger back
+        self.logger.propagate = False
+        self.plugin_file_handler = logging.NullHandler()
+        self.indigo_log_handler = logging.StreamHandler()
+        self.logger.addHandler(self.indigo_log_handler)
+
+    def device_deleted(self, device):
+        self.device_stop_comm(device)
+
+    def savePluginPrefs(self):
+        counters.add('prefs_saves')
+
+    def sleep(self, seconds):
+        threading.Event().wait(seconds)
+
+
+devices = DeviceList()
+triggers = TriggerList()
+trigger = _Trigger()
+server = _Server()
+
+
+def reset():
+    """Forget every device and trigger, and zero the counters, before starting another plugin instance."""
+    devices.clear()
+    triggers.clear()
+    counters.reset()
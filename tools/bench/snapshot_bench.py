@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compare what keeping a poll's vehicle data costs, before and after VehicleSnapshot.
+
+    before: json.loads(json.dumps(vehicle, cls=MyBMWJSONEncoder)) into a dict, then json.dumps of that dict
+            for every fetchVehicleData read
+    after:  VehicleSnapshot.from_vehicle, then to_json, which splices in the encoding made at poll time
+
+Vehicles are built by bimmer_connected from the recorded fixtures, through the stub API, so the encoder
+sees the same objects it does in the plugin.
+
+    python tools/bench/snapshot_bench.py --vehicles 20 --reads 1 --iterations 50
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+BENCH_FOLDER = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_FOLDER = os.path.join(BENCH_FOLDER, "..", "..", "ConnectedDrive.indigoPlugin", "Contents", "Server Plugin")
+sys.path.insert(0, os.path.abspath(PLUGIN_FOLDER))
+sys.path.insert(0, BENCH_FOLDER)     # ahead of the plugin, so "import indigo" finds the stand-in
+
+import stub_api  # noqa: E402
+from plugin import VehicleSnapshot  # noqa: E402
+from bimmer_connected.account import MyBMWAccount  # noqa: E402
+from bimmer_connected.api.regions import get_region_from_name  # noqa: E402
+from bimmer_connected.utils import MyBMWJSONEncoder  # noqa: E402
+
+ACCOUNT = 1
+
+
+def load_vehicles(fixtures, count):
+    stub = stub_api.StubMyBMW(stub_api.load_fixtures(fixtures))
+    tokens = stub.add_account(0, count)
+
+    async def get_vehicles():
+        account = MyBMWAccount("bench", "bench", get_region_from_name("north_america"))
+        account.set_refresh_token(**tokens)
+        await account.get_vehicles()
+        return account.vehicles
+
+    with stub:
+        return asyncio.run(get_vehicles())
+
+
+def poll_before(vehicles, reads):
+    vehicle_data = {}
+    for vehicle in vehicles:
+        vehicle_data[vehicle.vin] = {'account': ACCOUNT, 'fetched': time.time(), 'cached': False,
+                                     'vehicle': json.loads(json.dumps(vehicle, cls=MyBMWJSONEncoder))}
+    for _ in range(reads):
+        for entry in vehicle_data.values():
+            json.dumps({**entry, 'age': time.time() - entry['fetched']})
+    return vehicle_data
+
+
+def poll_after(vehicles, reads):
+    vehicle_data = {}
+    for vehicle in vehicles:
+        vehicle_data[vehicle.vin] = VehicleSnapshot.from_vehicle(ACCOUNT, vehicle)
+    for _ in range(reads):
+        for snapshot in vehicle_data.values():
+            snapshot.to_json(age=snapshot.age)
+    return vehicle_data
+
+
+def measure(poll, vehicles, reads, iterations):
+    """
+    CPU seconds per poll over iterations, then one more poll under tracemalloc for its peak allocation
+    and what it leaves in vehicle_data.
+    """
+    times = []
+    for _ in range(iterations):
+        started = time.process_time()
+        poll(vehicles, reads)
+        times.append(time.process_time() - started)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    blocks = sys.getallocatedblocks()
+    vehicle_data = poll(vehicles, reads)
+    retained, peak = tracemalloc.get_traced_memory()
+    retained_blocks = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    del vehicle_data
+
+    count = len(vehicles)
+    return {
+        'cpu_per_vehicle_us': round(statistics.median(times) / count * 1e6, 1),
+        'cpu_per_vehicle_us_min': round(min(times) / count * 1e6, 1),
+        'peak_kib': round((peak - baseline) / 1024.0, 1),
+        'retained_kib_per_vehicle': round((retained - baseline) / count / 1024.0, 2),
+        'retained_blocks_per_vehicle': round(retained_blocks / count, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time vehicle snapshots against the encode/decode round trip they replaced.")
+    parser.add_argument("--vehicles", type=int, default=20, help="vehicles per poll, cycling through the fixtures")
+    parser.add_argument("--reads", type=int, default=1, help="fetchVehicleData reads of every vehicle per poll")
+    parser.add_argument("--iterations", type=int, default=50, help="polls to time for each approach")
+    parser.add_argument("--fixtures", default=stub_api.FIXTURES_FOLDER, help="folder of recorded vehicle fixtures")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    vehicles = load_vehicles(args.fixtures, args.vehicles)
+    # the encoder adds each vehicle's properties to its __dict__ the first time, keep that out of the timings
+    poll_before(vehicles, 0)
+
+    results = {name: measure(poll, vehicles, args.reads, args.iterations)
+               for name, poll in (("before", poll_before), ("after", poll_after))}
+    if args.json:
+        print(json.dumps({'config': vars(args), **results}, indent=4))
+        return
+
+    print(f"{len(vehicles)} vehicles, {args.reads} reads per poll, {args.iterations} polls each")
+    columns = [('cpu_per_vehicle_us', "cpu us/veh"), ('cpu_per_vehicle_us_min', "min us/veh"), ('peak_kib', "peak KiB"),
+               ('retained_kib_per_vehicle', "kept KiB/veh"), ('retained_blocks_per_vehicle', "blocks/veh")]
+    print(f"{'':>8}" + "".join(f"{title:>14}" for _, title in columns))
+    for name, result in results.items():
+        print(f"{name:>8}" + "".join(f"{result[key]:>14}" for key, _ in columns))
+    print(f"{'ratio':>8}" + "".join(f"{results['after'][key] / results['before'][key] if results['before'][key] else 0:>14.2f}"
+                                    for key, _ in columns))
+
+
+if __name__ == "__main__":
+    main()
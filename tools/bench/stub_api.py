@@ -0,0 +1,288 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# A stand-in for the MyBMW API that replays recorded vehicle fixtures, for benchmarking the plugin
+# without a car or an account.  It patches httpx through respx, so bimmer_connected runs unchanged.
+
+import asyncio
+import copy
+import glob
+import json
+import os
+import random
+import time
+import urllib.parse
+import uuid
+from collections import Counter
+
+import httpx
+import respx
+
+from bimmer_connected.const import CarBrands
+
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+TOKEN_EXPIRES_IN = 28799        # what the real API reports, in seconds
+EVENT_STATUSES = ["PENDING", "DELIVERED", "EXECUTED"]
+
+
+def load_fixtures(folder=FIXTURES_FOLDER):
+    """
+    Read the vehicles written by the plugin's Record Vehicle Fixtures menu item.
+    Returns {fixture VIN: encoded vehicle, decoded}.
+    """
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(folder, "*.json"))):
+        with open(path, "r") as f:
+            vehicle = json.load(f)
+        fixtures[vehicle['vin']] = vehicle
+    if not fixtures:
+        raise ValueError(f"no vehicle fixtures found in {folder}")
+    return fixtures
+
+
+class StubVehicle:
+    """
+    One vehicle the stub serves, built from a fixture.  The raw API responses are kept in the
+    form bimmer_connected combined them, so they are split back out per endpoint.
+    """
+
+    def __init__(self, vin, fixture):
+        data = fixture['data']
+        self.vin = vin
+        self.brand = str(data['attributes'].get('brand', "bmw")).lower()
+        if self.brand not in {brand.value for brand in CarBrands}:
+            self.brand = CarBrands.BMW.value
+        self.profile = {**data['attributes'], 'vin': vin}
+        self.state = {'state': copy.deepcopy(data['state']), 'capabilities': data['capabilities']}
+        self.charging_settings = data.get('charging_settings')
+
+
+class StubMyBMW(respx.MockRouter):
+    """
+    Serves the vehicle list, profile, state, charging settings, remote service and OAuth endpoints.
+
+    latency: seconds added to every response, jitter: +/- fraction of that, randomized per request
+    error_rate: fraction of vehicle and remote service requests answered with a 500
+    quota_rate: fraction answered with a 429, which bimmer_connected waits out and retries
+    token_lifetime: seconds an access token works before the stub answers 401, even though it was
+        issued with the usual expires_in.  0 means tokens never expire.
+
+    Refresh tokens only work once, like the real API, so two logins racing with the same refresh token
+    show up as refresh_rejected.
+    """
+
+    # see https://github.com/lundberg/respx/issues/277
+    using = "httpx"
+
+    def __init__(self, fixtures, latency=0.0, jitter=0.0, error_rate=0.0, quota_rate=0.0, token_lifetime=0.0, seed=None):
+        super().__init__(assert_all_called=False)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.token_lifetime = token_lifetime
+        self.random = random.Random(seed)
+
+        self.vehicles = {}          # VIN -> StubVehicle
+        self.accounts = {}          # account -> [VIN]
+        self.access_tokens = {}     # access token -> (account, issued at)
+        self.refresh_tokens = {}    # refresh token -> account, removed when used
+        self.events = {}            # remote service event id -> statuses still to report
+
+        self.requests = Counter()
+        self.cpu = 0.0              # thread CPU seconds spent building responses
+
+        self.add_routes()
+
+    def add_account(self, account, vehicle_count, vin_format="BENCH{account:04d}{index:08d}"):
+        """
+        Give an account vehicle_count vehicles, cycling through the fixtures.
+        Returns the tokens to seed the plugin with, as {refresh_token, gcid, access_token}.
+        """
+        fixture_list = list(self.fixtures.values())
+        vins = []
+        for index in range(vehicle_count):
+            vin = vin_format.format(account=account, index=index)
+            fixture = fixture_list[(account * vehicle_count + index) % len(fixture_list)]
+            self.vehicles[vin] = StubVehicle(vin, fixture)
+            vins.append(vin)
+        self.accounts[account] = vins
+        return self.issue_tokens(account)
+
+    def issue_tokens(self, account):
+        access_token = f"access-{account}-{uuid.uuid4().hex}"
+        refresh_token = f"refresh-{account}-{uuid.uuid4().hex}"
+        self.access_tokens[access_token] = (account, time.monotonic())
+        self.refresh_tokens[refresh_token] = account
+        return {'refresh_token': refresh_token, 'gcid': f"gcid-{account}", 'access_token': access_token}
+
+    def churn(self, fraction):
+        """
+        Make a fraction of the vehicles report new data, as if they had moved since the last poll.
+        Returns how many changed.
+        """
+        changed = self.random.sample(sorted(self.vehicles), round(len(self.vehicles) * fraction))
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        for vin in changed:
+            state = self.vehicles[vin].state['state']
+            state['currentMileage'] = state.get('currentMileage', 0) + self.random.randint(1, 25)
+            state['lastFetched'] = now
+        return len(changed)
+
+    def stats(self):
+        return {'requests': dict(self.requests), 'cpu': round(self.cpu, 4)}
+
+    def reset_stats(self):
+        self.requests.clear()
+        self.cpu = 0.0
+
+    ########################################
+    # Routes
+    ########################################
+
+    def add_routes(self):
+        self.get("/eadrax-ucs/v1/presentation/oauth/config").mock(side_effect=self.wrap("oauth_config", self.oauth_config, api=False))
+        self.post("/gcdm/oauth/token").mock(side_effect=self.wrap("token", self.token, api=False))
+
+        self.post("/eadrax-vcs/v5/vehicle-list").mock(side_effect=self.wrap("vehicle_list", self.vehicle_list))
+        self.get("/eadrax-vcs/v5/vehicle-data/profile").mock(side_effect=self.wrap("profile", self.profile))
+        self.get("/eadrax-vcs/v4/vehicles/state").mock(side_effect=self.wrap("state", self.state))
+        self.get("/eadrax-crccs/v2/vehicles").mock(side_effect=self.wrap("charging_settings", self.charging_settings))
+
+        self.post("/eadrax-vrccs/v3/presentation/remote-commands/eventStatus").mock(
+            side_effect=self.wrap("event_status", self.event_status))
+        self.post(path__regex=r"/eadrax-vrccs/v4/presentation/remote-commands/(?!event)(?P<service>[^/]+)$").mock(
+            side_effect=self.wrap("remote_service", self.remote_service))
+        self.post(path__regex=r"/eadrax-crccs/v1/vehicles/(?P<vin>[^/]+)/(?P<service>(start|stop)-charging)$").mock(
+            side_effect=self.wrap("remote_service", self.remote_service))
+        self.post(path__regex=r"/eadrax-dcs/v2/user/(?P<gcid>[^/]+)/send-to-car$").mock(
+            side_effect=self.wrap("send_poi", lambda request, account, gcid: httpx.Response(201)))
+
+    def wrap(self, name, handler, api=True):
+        """
+        Count the request, check its access token and inject failures for API routes, then answer after the latency.
+        The side effect is a coroutine, so the latency is awaited on whatever loop made the request.
+        """
+        async def side_effect(request, **kwargs):
+            started = time.thread_time()
+            self.requests[name] += 1
+            response = None
+            account = None
+            if api:
+                account = self.authorize(request)
+                if account is None:
+                    self.requests['unauthorized'] += 1
+                    response = httpx.Response(401, json={'message': "Unauthorized"})
+                elif self.random.random() < self.error_rate:
+                    self.requests['errors_injected'] += 1
+                    response = httpx.Response(500, json={'message': "Internal server error (stub)"})
+                elif self.random.random() < self.quota_rate:
+                    self.requests['quota_injected'] += 1
+                    response = httpx.Response(429, json={'message': "Rate limit is exceeded. Try again in 1 seconds."})
+            if response is None:
+                response = handler(request, account, **kwargs) if api else handler(request)
+            self.cpu += time.thread_time() - started
+
+            if self.latency:
+                await asyncio.sleep(self.latency * self.random.uniform(1.0 - self.jitter, 1.0 + self.jitter))
+            return response
+
+        return side_effect
+
+    def authorize(self, request):
+        # the account an access token belongs to, or None once the token is unknown or has expired
+        token = request.headers.get("authorization", "").removeprefix("Bearer ")
+        account, issued = self.access_tokens.get(token, (None, 0.0))
+        if account is not None and self.token_lifetime and time.monotonic() - issued > self.token_lifetime:
+            del self.access_tokens[token]
+            return None
+        return account
+
+    def account_vehicle(self, request, account, vin=None):
+        vin = vin or request.headers.get("bmw-vin")
+        if vin not in self.accounts.get(account, ()):
+            return None
+        return self.vehicles[vin]
+
+    ########################################
+    # Authentication
+    ########################################
+
+    @staticmethod
+    def oauth_config(request):
+        return httpx.Response(200, json={
+            'clientName': "mybmwapp",
+            'clientId': "clientId",
+            'clientSecret': "clientSecret",
+            'returnUrl': "com.bmw.connected://oauth",
+            'tokenEndpoint': "https://customer.bmwgroup.com/gcdm/oauth/token",
+            'scopes': ["openid", "profile", "vehicle_data", "remote_services"],
+        })
+
+    def token(self, request):
+        form = urllib.parse.parse_qs(request.content.decode())
+        refresh_token = form.get('refresh_token', [None])[0]
+        account = self.refresh_tokens.pop(refresh_token, None)
+        if account is None:
+            self.requests['refresh_rejected'] += 1
+            return httpx.Response(401, json={'error': "invalid_grant"})
+        tokens = self.issue_tokens(account)
+        self.requests['logins'] += 1
+        return httpx.Response(200, json={
+            'access_token': tokens['access_token'],
+            'refresh_token': tokens['refresh_token'],
+            'gcid': tokens['gcid'],
+            'expires_in': TOKEN_EXPIRES_IN,
+            'token_type': "Bearer",
+            'scope': "vehicle_data remote_services",
+            'usid': "stub",
+        })
+
+    ########################################
+    # Vehicle data
+    ########################################
+
+    def vehicle_list(self, request, account):
+        user_agent = request.headers.get("x-user-agent", "").split(";")
+        brand = user_agent[1] if len(user_agent) == 4 else ""
+        vins = [vin for vin in self.accounts.get(account, ()) if self.vehicles[vin].brand == brand]
+        return httpx.Response(200, json={'mappingInfos': [{'vin': vin, 'mappingType': "PRIMARY"} for vin in vins]})
+
+    def profile(self, request, account):
+        if not (vehicle := self.account_vehicle(request, account)):
+            return httpx.Response(404)
+        return httpx.Response(200, json=vehicle.profile)
+
+    def state(self, request, account):
+        if not (vehicle := self.account_vehicle(request, account)):
+            return httpx.Response(404)
+        return httpx.Response(200, json=vehicle.state)
+
+    def charging_settings(self, request, account):
+        if not (vehicle := self.account_vehicle(request, account)) or vehicle.charging_settings is None:
+            return httpx.Response(404)
+        return httpx.Response(200, json=vehicle.charging_settings)
+
+    ########################################
+    # Remote services
+    ########################################
+
+    def remote_service(self, request, account, service, vin=None):
+        if not (vehicle := self.account_vehicle(request, account, vin)):
+            return httpx.Response(404)
+        if service in ("door-lock", "door-unlock"):
+            doors = vehicle.state['state'].setdefault('doorsState', {})
+            doors['combinedSecurityState'] = "LOCKED" if service == "door-lock" else "UNLOCKED"
+        event_id = str(uuid.uuid4())
+        self.events[event_id] = list(EVENT_STATUSES)
+        return httpx.Response(200, json={'eventId': event_id, 'creationTime': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())})
+
+    def event_status(self, request, account):
+        statuses = self.events.get(request.url.params.get("eventId"))
+        if not statuses:
+            return httpx.Response(200, json={'eventStatus': "ERROR"})
+        status = statuses.pop(0)
+        if not statuses:
+            del self.events[request.url.params.get("eventId")]
+        return httpx.Response(200, json={'eventStatus': status})